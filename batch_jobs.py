@@ -0,0 +1,582 @@
+# %% Batch jobs
+
+from recognition_worker import recognize_document
+from executors import run_blocking
+from utils.file_utils import FileUtils
+from fastapi.encoders import jsonable_encoder
+from dotenv import load_dotenv
+from io import BytesIO
+import threading
+import zipfile
+import socket
+import sqlite3
+import asyncio
+import json
+import time
+import uuid
+import os
+
+"""
+Persistent queue for bulk document ingestion.
+
+A batch is a set of documents (several files or a zip) submitted at once. Each
+document becomes a job stored in a local SQLite database, and its content is
+written to BATCH_FOLDER until the job finishes, so the queue survives a restart.
+
+A claimed job is leased to the worker process that took it for BATCH_LEASE_SECONDS,
+and the lease is renewed while the job runs. Several service processes can share
+the database: a job is only taken again when its lease expired (the process that
+held it died), and after BATCH_MAX_ATTEMPTS interrupted attempts it is marked as
+failed, so a document that crashes the process is not retried forever.
+
+A pool of BATCH_WORKERS async workers takes the jobs in submission order and
+runs them through recognize_document, the same path as /ocr_recognize (result
+cache included). The number of workers bounds the documents processed at the
+same time, and the page semaphores of executors bound the calls to Textract and
+the LLMs, so the throughput follows the backend limits instead of the HTTP
+round trips of a client.
+
+- BATCH_MAX_FILES: documents accepted per batch.
+- BATCH_MAX_FILE_MB: size of a single document, also applied to the zip entries.
+- BATCH_MAX_TOTAL_MB: uncompressed size of all the documents of a batch. The zip
+  entries are counted and measured from the zip directory before any is read.
+- BATCH_MAX_ATTEMPTS: attempts of a job that fails with an unexpected error
+  (network, throttling). Invalid documents (ValueError) are not retried.
+- BATCH_RETRY_SECONDS: wait before the first retry, doubled on every attempt.
+"""
+
+load_dotenv()
+BATCH_FOLDER = os.environ.get("BATCH_FOLDER", os.path.join(os.getcwd(), ".batch"))
+BATCH_DB_PATH = os.environ.get("BATCH_DB_PATH", os.path.join(BATCH_FOLDER, "jobs.sqlite3"))
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", 4))
+BATCH_MAX_FILES = int(os.environ.get("BATCH_MAX_FILES", 5000))
+BATCH_MAX_FILE_MB = float(os.environ.get("BATCH_MAX_FILE_MB", 20))
+BATCH_MAX_TOTAL_MB = float(os.environ.get("BATCH_MAX_TOTAL_MB", 1024))
+BATCH_MAX_ATTEMPTS = int(os.environ.get("BATCH_MAX_ATTEMPTS", 3))
+# Segundos que espera un worker sin trabajo antes de volver a consultar la cola
+BATCH_POLL_SECONDS = float(os.environ.get("BATCH_POLL_SECONDS", 2))
+BATCH_LEASE_SECONDS = float(os.environ.get("BATCH_LEASE_SECONDS", 60))
+BATCH_RETRY_SECONDS = float(os.environ.get("BATCH_RETRY_SECONDS", 30))
+DOC_TYPES = ("IMSS", "INFONAVIT", "SAT")
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS batches (
+    id TEXT PRIMARY KEY,
+    doc_type TEXT NOT NULL,
+    num_jobs INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    batch_id TEXT NOT NULL REFERENCES batches(id),
+    seq INTEGER NOT NULL,
+    filename TEXT NOT NULL,
+    doc_type TEXT NOT NULL,
+    file_path TEXT,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    done_seq INTEGER,
+    owner TEXT,
+    lease_expires_at REAL,
+    not_before REAL NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at, seq);
+CREATE INDEX IF NOT EXISTS jobs_batch ON jobs (batch_id, seq);
+CREATE INDEX IF NOT EXISTS jobs_batch_done ON jobs (batch_id, done_seq);
+"""
+
+
+def check_batch_limits(num_files, total_bytes, max_files, max_total_bytes):
+    """
+    Raises ValueError if the documents exceed the remaining files or bytes of the batch.
+    """
+    if num_files > max_files:
+        raise ValueError(f"El lote excede el maximo de {BATCH_MAX_FILES} documentos.")
+    if total_bytes > max_total_bytes:
+        raise ValueError(f"El lote excede {BATCH_MAX_TOTAL_MB} MB sin comprimir.")
+
+
+def expand_upload(
+    file_name, file_bytes, max_files=BATCH_MAX_FILES, max_total_bytes=BATCH_MAX_TOTAL_MB * 1024 * 1024
+) -> list:
+    """
+    Returns the documents of an uploaded file: the file itself, or the PDF and image
+    entries of a zip. Folders, hidden files and unsupported entries of a zip are skipped.
+    The entries of a zip are counted and their sizes added from its directory before any
+    of them is decompressed, so a zip bomb is rejected without using memory.
+        Args:
+            file_name: Name of the uploaded file.
+            file_bytes: Content of the uploaded file.
+            max_files: Documents still accepted in the batch.
+            max_total_bytes: Bytes still accepted in the batch.
+        Returns:
+            list: (file_name, file_bytes) tuples.
+    """
+    max_bytes = BATCH_MAX_FILE_MB * 1024 * 1024
+    if not file_name.lower().endswith(".zip"):
+        if FileUtils.identify_file(file_name) == "other":
+            raise ValueError(f"Tipo de archivo no soportado: {file_name}.")
+        if len(file_bytes) > max_bytes:
+            raise ValueError(f"El archivo {file_name} excede {BATCH_MAX_FILE_MB} MB.")
+        check_batch_limits(1, len(file_bytes), max_files, max_total_bytes)
+        return [(file_name, file_bytes)]
+
+    try:
+        archive = zipfile.ZipFile(BytesIO(file_bytes))
+    except zipfile.BadZipFile:
+        raise ValueError(f"El archivo {file_name} no es un zip valido.")
+    with archive:
+        entries = []
+        for info in archive.infolist():
+            entry_name = os.path.basename(info.filename)
+            if (
+                info.is_dir()
+                or info.filename.startswith("__MACOSX/")
+                or entry_name.startswith(".")
+                or FileUtils.identify_file(entry_name) == "other"
+            ):
+                continue
+            # El tamaño se revisa antes de descomprimir la entrada
+            if info.file_size > max_bytes:
+                raise ValueError(f"El archivo {info.filename} excede {BATCH_MAX_FILE_MB} MB.")
+            entries.append(info)
+        if not entries:
+            raise ValueError(f"El zip {file_name} no contiene documentos PDF o imagenes.")
+        check_batch_limits(len(entries), sum(info.file_size for info in entries), max_files, max_total_bytes)
+        return [(info.filename, archive.read(info)) for info in entries]
+
+
+class JobQueue:
+    """
+    SQLite queue of the batch jobs. Every method is blocking and is called through
+    run_blocking; a single connection is shared under a lock.
+        Args:
+            db_path: Path of the SQLite database.
+            files_folder: Folder where the content of the pending jobs is stored.
+    """
+
+    def __init__(self, db_path=BATCH_DB_PATH, files_folder=os.path.join(BATCH_FOLDER, "files")):
+        self.db_path = db_path
+        self.files_folder = files_folder
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        os.makedirs(files_folder, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # Espera a otros procesos que escriben en la misma base en lugar de fallar de inmediato
+        self._connection.execute("PRAGMA busy_timeout=30000")
+        self._connection.executescript(SCHEMA)
+        self._migrate()
+        # Identifica al proceso dueño de los trabajos que toma
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def _migrate(self):
+        """
+        Adds the lease columns to a database created before them. Jobs left running
+        without a lease are considered expired.
+        """
+        columns = {row["name"] for row in self._connection.execute("PRAGMA table_info(jobs)")}
+        for column, definition in (
+            ("owner", "TEXT"),
+            ("lease_expires_at", "REAL"),
+            ("not_before", "REAL NOT NULL DEFAULT 0"),
+        ):
+            if column not in columns:
+                self._connection.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+        self._connection.execute(
+            "UPDATE jobs SET lease_expires_at = 0 WHERE status = ? AND lease_expires_at IS NULL", (RUNNING,)
+        )
+
+    def _transaction(self, statements):
+        """
+        Runs a function with the connection inside a single write transaction.
+        """
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(self._connection)
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+            return result
+
+    def _query(self, sql, parameters=()) -> list:
+        with self._lock:
+            return [dict(row) for row in self._connection.execute(sql, parameters)]
+
+    def create_batch(self, documents, doc_type) -> dict:
+        """
+        Stores the documents of a batch and queues one job per document.
+            Args:
+                documents: (file_name, file_bytes) tuples.
+                doc_type: Type of the documents (IMSS, INFONAVIT, SAT).
+            Returns:
+                dict: The batch id and the number of jobs queued.
+        """
+        batch_id = uuid.uuid4().hex
+        now = time.time()
+        jobs = []
+        try:
+            for seq, (file_name, file_bytes) in enumerate(documents):
+                job_id = uuid.uuid4().hex
+                file_path = os.path.join(self.files_folder, job_id)
+                with open(file_path, "wb") as file:
+                    file.write(file_bytes)
+                jobs.append((job_id, batch_id, seq, file_name, doc_type, file_path, QUEUED, now, now))
+
+            def insert(connection):
+                connection.execute(
+                    "INSERT INTO batches (id, doc_type, num_jobs, created_at) VALUES (?, ?, ?, ?)",
+                    (batch_id, doc_type, len(jobs), now),
+                )
+                connection.executemany(
+                    "INSERT INTO jobs (id, batch_id, seq, filename, doc_type, file_path, status, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    jobs,
+                )
+
+            self._transaction(insert)
+        except BaseException:
+            for job in jobs:
+                self._remove_file(job[5])
+            raise
+        return {"batch_id": batch_id, "num_jobs": len(jobs)}
+
+    def claim_job(self) -> dict:
+        """
+        Leases the oldest job that is queued and due, or whose lease expired, and returns it.
+        Returns None if there is nothing to do. Jobs whose lease expired after their last
+        attempt are marked as failed instead of being taken again.
+        """
+
+        def claim(connection):
+            now = time.time()
+            # Los trabajos agotados se marcan como fallidos, su contenido se borra al confirmar
+            expired = connection.execute(
+                "SELECT id, file_path FROM jobs WHERE status = ? AND lease_expires_at < ? AND attempts >= ?",
+                (RUNNING, now, BATCH_MAX_ATTEMPTS),
+            ).fetchall()
+            for expired_job in expired:
+                print(f"Batch job {expired_job['id']} was interrupted on every attempt, marked as failed")
+                connection.execute(
+                    "UPDATE jobs SET status = ?, error = ?, file_path = NULL, owner = NULL, updated_at = ?, "
+                    "done_seq = (SELECT COALESCE(MAX(done_seq), 0) + 1 FROM jobs) WHERE id = ?",
+                    (FAILED, "El proceso se interrumpio en cada intento.", now, expired_job["id"]),
+                )
+            expired_paths = [expired_job["file_path"] for expired_job in expired]
+            row = connection.execute(
+                "SELECT * FROM jobs WHERE (status = ? AND not_before <= ?) OR (status = ? AND lease_expires_at < ?) "
+                "ORDER BY created_at, seq LIMIT 1",
+                (QUEUED, now, RUNNING, now),
+            ).fetchone()
+            if row is None:
+                return None, expired_paths
+            if row["status"] == RUNNING:
+                print(f"Batch job {row['id']} lease of {row['owner']} expired, taking it again")
+            connection.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, owner = ?, lease_expires_at = ?, "
+                "updated_at = ? WHERE id = ?",
+                (RUNNING, self.worker_id, now + BATCH_LEASE_SECONDS, now, row["id"]),
+            )
+            job = dict(row)
+            job["attempts"] += 1
+            return job, expired_paths
+
+        job, expired_paths = self._transaction(claim)
+        for file_path in expired_paths:
+            self._remove_file(file_path)
+        return job
+
+    def renew_lease(self, job) -> bool:
+        """
+        Extends the lease of a running job. Returns False if the job is no longer leased to this process.
+        """
+        return self._transaction(
+            lambda connection: connection.execute(
+                "UPDATE jobs SET lease_expires_at = ?, updated_at = ? WHERE id = ? AND owner = ? AND status = ?",
+                (time.time() + BATCH_LEASE_SECONDS, time.time(), job["id"], self.worker_id, RUNNING),
+            ).rowcount
+            == 1
+        )
+
+    def finish_job(self, job, result=None, error=None) -> bool:
+        """
+        Stores the result (or the error) of a job and deletes its content. Nothing is stored
+        if the lease was lost, since another process owns the job now.
+        """
+
+        def finish(connection):
+            return connection.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, file_path = NULL, owner = NULL, updated_at = ?, "
+                "done_seq = (SELECT COALESCE(MAX(done_seq), 0) + 1 FROM jobs) "
+                "WHERE id = ? AND owner = ? AND status = ?",
+                (
+                    FAILED if error is not None else DONE,
+                    json.dumps(result) if error is None else None,
+                    error,
+                    time.time(),
+                    job["id"],
+                    self.worker_id,
+                    RUNNING,
+                ),
+            ).rowcount
+
+        if self._transaction(finish) != 1:
+            print(f"Batch job {job['id']} is no longer leased to this process, result discarded")
+            return False
+        self._remove_file(job["file_path"])
+        return True
+
+    def retry_job(self, job, error) -> bool:
+        """
+        Queues a job again after an unexpected error, with an exponential backoff so
+        throttled backends are not called again right away.
+        """
+        delay = BATCH_RETRY_SECONDS * 2 ** (job["attempts"] - 1)
+        return self._transaction(
+            lambda connection: connection.execute(
+                "UPDATE jobs SET status = ?, error = ?, owner = NULL, not_before = ?, updated_at = ? "
+                "WHERE id = ? AND owner = ? AND status = ?",
+                (QUEUED, error, time.time() + delay, time.time(), job["id"], self.worker_id, RUNNING),
+            ).rowcount
+            == 1
+        )
+
+    def batch_status(self, batch_id) -> dict:
+        """
+        Returns the progress of a batch and the status of its jobs, None if it does not exist.
+        """
+        batches = self._query("SELECT * FROM batches WHERE id = ?", (batch_id,))
+        if not batches:
+            return None
+        jobs = self._query(
+            "SELECT id, filename, status, attempts, error FROM jobs WHERE batch_id = ? ORDER BY seq",
+            (batch_id,),
+        )
+        counts = {status: 0 for status in (QUEUED, RUNNING, DONE, FAILED)}
+        for job in jobs:
+            counts[job["status"]] += 1
+        return {
+            "batch_id": batch_id,
+            "doc_type": batches[0]["doc_type"],
+            "num_jobs": batches[0]["num_jobs"],
+            "counts": counts,
+            "finished": counts[DONE] + counts[FAILED] == batches[0]["num_jobs"],
+            "jobs": jobs,
+        }
+
+    def job(self, batch_id, job_id) -> dict:
+        """
+        Returns a job of a batch with its result, None if it does not exist.
+        """
+        jobs = self._query(
+            "SELECT id, filename, status, attempts, result, error FROM jobs WHERE batch_id = ? AND id = ?",
+            (batch_id, job_id),
+        )
+        if not jobs:
+            return None
+        job = jobs[0]
+        job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+        return job
+
+    def finished_jobs(self, batch_id, after=0, limit=100) -> list:
+        """
+        Returns the jobs of a batch finished after the given position, in completion order.
+        """
+        return self._query(
+            "SELECT id, filename, status, result, error, done_seq FROM jobs "
+            "WHERE batch_id = ? AND done_seq > ? ORDER BY done_seq LIMIT ?",
+            (batch_id, after, limit),
+        )
+
+    def pending_jobs(self, batch_id) -> int:
+        """
+        Returns the number of jobs of a batch that are queued or running.
+        """
+        return self._query(
+            "SELECT COUNT(*) AS pending FROM jobs WHERE batch_id = ? AND status IN (?, ?)",
+            (batch_id, QUEUED, RUNNING),
+        )[0]["pending"]
+
+    @staticmethod
+    def _read_file(file_path) -> bytes:
+        with open(file_path, "rb") as file:
+            return file.read()
+
+    @staticmethod
+    def _remove_file(file_path):
+        if file_path and os.path.exists(file_path):
+            os.remove(file_path)
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+_new_jobs = None
+
+
+def get_job_queue() -> JobQueue:
+    """
+    Returns the job queue of the process, opening the database on first use.
+    """
+    global _job_queue
+    if _job_queue is None:
+        with _job_queue_lock:
+            if _job_queue is None:
+                _job_queue = JobQueue()
+    return _job_queue
+
+
+async def submit_batch(uploads, doc_type) -> dict:
+    """
+    Queues the documents of a batch.
+        Args:
+            uploads: (file_name, file_bytes) tuples, zips are expanded.
+            doc_type: Type of the documents (IMSS, INFONAVIT, SAT).
+        Returns:
+            dict: The batch id and the number of jobs queued.
+    """
+    if doc_type not in DOC_TYPES:
+        raise ValueError(
+            "Tipo de documento no reconocido. Por favor, proporciona un tipo valido: IMSS, INFONAVIT, SAT"
+        )
+    documents = []
+    total_bytes = 0
+    for file_name, file_bytes in uploads:
+        # Cada archivo solo puede usar lo que queda de los limites del lote
+        expanded = await run_blocking(
+            expand_upload,
+            file_name,
+            file_bytes,
+            BATCH_MAX_FILES - len(documents),
+            BATCH_MAX_TOTAL_MB * 1024 * 1024 - total_bytes,
+        )
+        documents += expanded
+        total_bytes += sum(len(data) for _, data in expanded)
+    if not documents:
+        raise ValueError("El lote no contiene documentos.")
+
+    batch = await run_blocking(get_job_queue().create_batch, documents, doc_type)
+    print(f"Batch {batch['batch_id']} queued with {batch['num_jobs']} documents")
+    if _new_jobs is not None:
+        _new_jobs.set()
+    return batch
+
+
+async def keep_lease(job_queue, job) -> None:
+    """
+    Renews the lease of a job while it runs, until it is cancelled.
+    """
+    while True:
+        await asyncio.sleep(BATCH_LEASE_SECONDS / 3)
+        try:
+            if not await run_blocking(job_queue.renew_lease, job):
+                print(f"Batch job {job['id']} lease lost")
+                return
+        except Exception as e:
+            print(f"Failed to renew the lease of batch job {job['id']}. Reason: {e}")
+
+
+async def process_job(job_queue, job) -> None:
+    """
+    Runs a job through the recognition pipeline and stores its result.
+    """
+    lease = asyncio.create_task(keep_lease(job_queue, job))
+    try:
+        file_bytes = await run_blocking(job_queue._read_file, job["file_path"])
+        result = await recognize_document(file_bytes, job["filename"], job["doc_type"])
+        await run_blocking(job_queue.finish_job, job, jsonable_encoder(result))
+    except ValueError as e:
+        await run_blocking(job_queue.finish_job, job, error=str(e))
+    except Exception as e:
+        print(f"Batch job {job['id']} failed on attempt {job['attempts']}. Reason: {e}")
+        if job["attempts"] < BATCH_MAX_ATTEMPTS:
+            await run_blocking(job_queue.retry_job, job, str(e))
+        else:
+            await run_blocking(job_queue.finish_job, job, error=str(e))
+    finally:
+        lease.cancel()
+
+
+async def batch_worker(job_queue) -> None:
+    """
+    Takes the queued jobs one at a time until it is cancelled. An error of the queue
+    (e.g. the database is locked) is logged and the worker keeps going.
+    """
+    while True:
+        try:
+            job = await run_blocking(job_queue.claim_job)
+            if job is None:
+                # Sin trabajo esperamos un lote nuevo o el siguiente sondeo
+                _new_jobs.clear()
+                try:
+                    await asyncio.wait_for(_new_jobs.wait(), BATCH_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await process_job(job_queue, job)
+        except Exception as e:
+            print(f"Batch worker error, retrying in {BATCH_POLL_SECONDS} seconds. Reason: {e}")
+            await asyncio.sleep(BATCH_POLL_SECONDS)
+
+
+async def start_workers(workers=BATCH_WORKERS) -> list:
+    """
+    Starts the worker pool. Jobs interrupted by a process that died are taken again
+    by any worker once their lease expires.
+        Returns:
+            list: The worker tasks, to be passed to stop_workers.
+    """
+    global _new_jobs
+    _new_jobs = asyncio.Event()
+    job_queue = await run_blocking(get_job_queue)
+    return [asyncio.create_task(batch_worker(job_queue)) for _ in range(workers)]
+
+
+async def stop_workers(tasks) -> None:
+    """
+    Cancels the worker pool. Jobs being processed are taken again when their lease expires.
+    """
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def stream_results(batch_id, follow=False):
+    """
+    Yields the finished jobs of a batch as NDJSON lines, in completion order.
+        Args:
+            batch_id: Id of the batch.
+            follow: Keep the stream open and yield the jobs as they finish, until the whole batch is done.
+    """
+    job_queue = get_job_queue()
+    after = 0
+    while True:
+        jobs = await run_blocking(job_queue.finished_jobs, batch_id, after)
+        for job in jobs:
+            after = job["done_seq"]
+            line = {"job_id": job["id"], "filename": job["filename"], "status": job["status"]}
+            if job["status"] == DONE:
+                line["data"] = json.loads(job["result"])
+            else:
+                line["detail"] = job["error"]
+            yield json.dumps(line, ensure_ascii=False) + "\n"
+        if jobs:
+            continue
+        if not follow:
+            return
+        if await run_blocking(job_queue.pending_jobs, batch_id) == 0:
+            # Una ultima lectura recoge los trabajos terminados despues de la consulta
+            follow = False
+            continue
+        await asyncio.sleep(BATCH_POLL_SECONDS)
@@ -1,20 +1,17 @@
 # %% Open AI Chat Completions
 
-from openai import OpenAI
-from dotenv import load_dotenv
-from utils.file_utils import FileUtils
 from utils.general_utils import Utils
+from example_store import get_chat_prompt, CHAT_MODEL
+from subtype_classifier import predict_subtype
+from clients import get_openai_client
+from executors import run_blocking
 import os
 import sys
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-load_dotenv()
-# OpenAI API Key
-OPEN_AI_API_KEY = os.environ.get("OPEN_AI_API_KEY")
 
-
-def chat_completions_entity_extraction(
+async def chat_completions_entity_extraction(
     extracted_text, data_inject_folder, type_doc
 ) -> dict:
     """
@@ -31,73 +28,22 @@ def chat_completions_entity_extraction(
         Return:
             A structured JSON with the relevant fields extracted.
     """
-    # Set Data for system from folder 'Data inject'
-    context_data_inyection = ""
-    input_results_list = []
-    input_txt_list = []
-    txt_count = 0
-    results_count = 0
-    all_data_inject_files = []
-    # Retrieve files from 'Data Inject'
-    if type_doc == "IMSS":
-        data_inject_sub_folder = os.path.join(data_inject_folder, "IMSS")
-        all_data_inject_files = FileUtils.get_paths(data_inject_sub_folder, 2)
-    elif type_doc == "INFONAVIT":
-        data_inject_sub_folder = os.path.join(data_inject_folder, "INFONAVIT")
-        all_data_inject_files = FileUtils.get_paths(data_inject_sub_folder, 2)
-    elif type_doc == "SAT":
-        data_inject_sub_folder = os.path.join(data_inject_folder, "SAT")
-        all_data_inject_files = FileUtils.get_paths(data_inject_sub_folder, 1)
-    else:
-        raise ValueError(
-            "Tipo de documento no reconozido. Por favor, proporcione un tipo de documento válido: IMSS, INFONAVIT, SAT"
-        )
-
-    for file in all_data_inject_files:
-        file_name = os.path.basename(file)
-        if file_name.startswith("result"):
-            input_results_list.append(FileUtils.read(file))
-            results_count += 1
-        elif file_name.startswith("data"):
-            input_txt_list.append(FileUtils.read(file))
-            txt_count += 1
-        else:
-            print(f"File {file} not recognized")
-
-    # Set context data
-    context_data_inyection = f"Your role is to extract relevant information from raw text. In between XML tags you will find {txt_count} examples of raw text inputs and information extracted outputs with the relevant entities to be recognized. \n\n"
-
-    txt_count = 1
-    results_count = 1
-    for input_txt, input_result in zip(input_txt_list, input_results_list):
-        context_data_inyection += f"<raw_text_input_example_{txt_count}>\n\n{input_txt}\n\n</raw_text_input_example_{txt_count}>\n\n<information_extracted_output_example_{results_count}>\n\n{input_result}\n\n</information_extracted_output_example_{results_count}>\n\n"
-        txt_count += 1
-        results_count += 1
-
-    context_data_inyection += "\nYou will recive a new raw text by the user. Your task is to analyse the raw text, recognize the entities to be extracted, and create a JSON with the relevant entities. Use the following format for the output JSON:\n\n"
-    if type_doc == "IMSS":
-        context_data_inyection += '{"serie_y_folio": "string", "tipo_incapacidad": "string", "ramo_de_seguro": "string", "probable_riesgo_trabajo": "string", "dias_autorizados": "string", "fecha_a_partir": "date (DD/MM/YYYY)", "fecha_expedido": "date (DD/MM/YYYY)", "numero_de_seguridad_social": "string", "curp": "string", "nombre_del_asegurado": "string", "clave_patronal": "string", "nombre_del_patron": "string"}'
-
-    elif type_doc == "INFONAVIT":
-        context_data_inyection += '{"titulo": "string", "motivo": "ALTA|SUSPENSION", "folio": "string", "fecha_notificacion": "date (DD/MM/YYYY)", "fecha_emision": "date (DD/MM/YYYY)", "fecha_tramite": "date (DD/MM/YYYY)", "fecha_recepcion": "date (DD/MM/YYYY)", "numero_de_credito": "string", "descuento": "oneOf": "[{"cantidad": "string"}, {"porcentaje": "string"}, {"factor": "string"}]", "rfc": "string", "numero_de_seguridad_social": "string", "rfc_patron": "string", "numero_de_registro_patronal": "string", "razon_social": "string", "sello_de_la_empresa": "true|false", "leyenda_aplicacion_descuento": "string"}'
-
-    elif type_doc == "SAT":
-        context_data_inyection += '{"codigo_postal": "number", "curp": "string", "nombres": "string", "primer_apellido": "string", "segundo_apellido": "string", "rfc": "string", "estatus_en_el_padron": "string"}'
-    else:
-        raise ValueError(
-            "Tipo de documento no reconozido. Por favor, proporcione un tipo de documento válido: IMSS, INFONAVIT, SAT"
-        )
-    # Set system role
-    system_content = {"role": "developer", "content": context_data_inyection}
+    # Set system role from the compiled prompt of 'Data inject', only with the examples
+    # of the predicted sub-type when the classifier is confident. Both lookups stat the
+    # example files and may rebuild the cache, so they run outside the event loop
+    sub_type = await run_blocking(predict_subtype, data_inject_folder, type_doc, extracted_text)
+    prompt = await run_blocking(get_chat_prompt, data_inject_folder, type_doc, sub_type)
+    system_content = prompt.message()
+    print(f"Developer prompt tokens: {prompt.num_tokens}")
 
     user_content = {"role": "user", "content": extracted_text}
 
-    # Create instance of openAI client
-    client = OpenAI(api_key=OPEN_AI_API_KEY)
+    # Shared instance of openAI client
+    client = get_openai_client()
 
     # Get response
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",  # gpt-4-0125-preview, #gpt-4-vision-preview , #gpt-4-turbo-preview
+    response = await client.chat.completions.create(
+        model=CHAT_MODEL,  # gpt-4-0125-preview, #gpt-4-vision-preview , #gpt-4-turbo-preview
         messages=[
             system_content,
             user_content,
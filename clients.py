@@ -0,0 +1,126 @@
+# %% API clients registry
+
+from botocore.config import Config
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from google import genai
+from google.genai import types
+from dotenv import load_dotenv
+import threading
+import httpx
+import boto3
+import os
+
+"""
+Long-lived clients for Textract, S3, OpenAI and Gemini.
+
+Each client is built once per process and shared by every request, so
+credentials are resolved once and the HTTP connections are kept alive and
+reused between calls instead of paying a new TLS handshake per page.
+
+- HTTP_POOL_SIZE: maximum connections per client.
+- HTTP_TIMEOUT: read timeout in seconds.
+- HTTP_CONNECT_TIMEOUT: connect timeout in seconds.
+- HTTP_MAX_RETRIES: retries on throttling and transient errors.
+- HTTP_KEEPALIVE_EXPIRY: seconds an idle connection is kept open.
+"""
+
+load_dotenv()
+AWS_ACCESS_KEY_ID = os.environ.get("AWS_ACCESS_KEY_ID")
+AWS_SECRET_ACCESS_KEY = os.environ.get("AWS_SECRET_ACCESS_KEY")
+REGION_NAME = os.environ.get("REGION_NAME")
+OPEN_AI_API_KEY = os.environ.get("OPEN_AI_API_KEY")
+GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
+
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 50))
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 60))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_MAX_RETRIES = int(os.environ.get("HTTP_MAX_RETRIES", 3))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", 60))
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def _get_client(name, factory):
+    """
+    Returns the client registered under name, building it with factory on first use.
+    """
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = factory()
+                _clients[name] = client
+    return client
+
+
+def _build_aws_client(service):
+    config = Config(
+        max_pool_connections=HTTP_POOL_SIZE,
+        connect_timeout=HTTP_CONNECT_TIMEOUT,
+        read_timeout=HTTP_TIMEOUT,
+        # botocore cuenta el intento inicial dentro de max_attempts
+        retries={"max_attempts": HTTP_MAX_RETRIES + 1, "mode": "adaptive"},
+        tcp_keepalive=True,
+    )
+    return boto3.client(
+        service,
+        region_name=REGION_NAME,
+        aws_access_key_id=AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        config=config,
+    )
+
+
+def _build_openai_client():
+    http_client = DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=HTTP_POOL_SIZE,
+            max_keepalive_connections=HTTP_POOL_SIZE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+    )
+    return AsyncOpenAI(
+        api_key=OPEN_AI_API_KEY,
+        max_retries=HTTP_MAX_RETRIES,
+        http_client=http_client,
+    )
+
+
+def _build_gemini_client():
+    # google-genai 1.5 abre un cliente httpx por llamada asincrona, por lo que aqui solo
+    # se comparte la construccion del cliente. HttpOptions.timeout se expresa en milisegundos
+    return genai.Client(
+        api_key=GEMINI_API_KEY,
+        http_options=types.HttpOptions(timeout=int(HTTP_TIMEOUT * 1000)),
+    )
+
+
+def get_textract_client():
+    """
+    Returns the shared boto3 Textract client. boto3 clients are thread safe.
+    """
+    return _get_client("textract", lambda: _build_aws_client("textract"))
+
+
+def get_s3_client():
+    """
+    Returns the shared boto3 S3 client, used to stage the PDFs of the Textract document mode.
+    """
+    return _get_client("s3", lambda: _build_aws_client("s3"))
+
+
+def get_openai_client() -> AsyncOpenAI:
+    """
+    Returns the shared async OpenAI client.
+    """
+    return _get_client("openai", _build_openai_client)
+
+
+def get_gemini_client() -> genai.Client:
+    """
+    Returns the shared Gemini client.
+    """
+    return _get_client("gemini", _build_gemini_client)
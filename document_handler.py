@@ -1,80 +1,142 @@
 from utils.file_utils import FileUtils
 from utils.general_utils import Utils
 from image_pre_procesing import (
-    pdf_has_text,
-    get_text_from_pdf,
-    pdf_to_image,
+    PdfDocument,
+    page_text_is_usable,
+    pdf_dpi,
     process_images,
 )
 from improve_image_quality import improve_image_quality
-from ocr_aws_textract import extract_text_from_image
-from base64 import b64encode
+from ocr_aws_textract import extract_text_from_pdf, use_document_mode
+from ocr_backends import extract_page_text
+from executors import run_cpu_bound, run_in_image_process, map_pages
+from workspace import Workspace, IMAGE_PREPROCESSED, IMAGE_IMPROVED
+from page_image import PageImage, LazyPageImage
 import os
 
-image_preprocessed_folder = os.path.join(os.getcwd(), "1_image_preprocessed")
-image_improved_folder = os.path.join(os.getcwd(), "2_image_improved")
 
-
-def document_handler(file_path=str, doctype=str) -> tuple|list:
+async def document_handler(file_bytes=bytes, file_name=str, doctype=str, workspace=Workspace, needs_image=None) -> tuple|list:
     """
     This function is the main function that handles the document processing. It identifies the type of file and processes it accordingly.
+    Every stage runs in memory; the workspace only persists the stages in debug mode.
     
         Args:
-            file_path (str): The file path that is going to be processed.
+            file_bytes (bytes): The content of the file that is going to be processed.
+            file_name (str): The name of the file that is going to be processed.
             doctype (str): Type of document to process. It can be one of the following: IMSS, INFONAVIT, SAT. _optional_
+            workspace (Workspace): Workspace of the request where the stages are saved in debug mode.
+            needs_image (callable): Receives (text_corpus, docConfidence, hasManuscript) of a page and tells
+                if its extraction needs the image. The raster of the pages that don't is released after OCR,
+                so the memory does not grow with the number of pages. _optional_
         
         Returns:
             tuple: 
-                with the text extracted, the improved image path and level of confidence.
+                with the text extracted, level of confidence and the improved page image (PageImage or LazyPageImage).
             list:
-                with the texts extracted from each page of a document and their improved images path and level of confidence.
+                with the texts extracted from each page of a document, their level of confidence and improved page images.
     """
-    # Borramos archivos dentro de las carpetas de prepocesado y mejora de documentos
-    FileUtils.delete_from_folder(image_preprocessed_folder)
-    FileUtils.delete_from_folder(image_improved_folder)
-
-    file_name = os.path.basename(file_path)
+    file_name = os.path.basename(file_name)
     filetype = FileUtils.identify_file(file_name)
-    text_corpus_pdf = ""
 
-    if filetype == "pdf":
+    async def improve_page(image) -> PageImage:
         """
-        If the file is a PDF, check if it has text. If it does, extract the text and save it as a .txt file.
+        Improves a page in the process pool and encodes it once for OCR.
         """
-        has_text = pdf_has_text(file_path)
-        if has_text:
-            text_corpus_pdf = get_text_from_pdf(file_path)
+        if workspace.debug:
+            workspace.save(IMAGE_PREPROCESSED, image.name, image.encode().data)
+        improved = await run_in_image_process(improve_image_quality, image.array)
+        if improved is None:
+            raise ValueError(f"No fue posible procesar la imagen {image.name}.")
+        improved_image = PageImage(image.name, improved, image.image_format)
+        if workspace.debug:
+            # Codificamos una sola vez dentro del presupuesto de Textract, el OCR reutiliza los bytes
+            encoded = await run_cpu_bound(improved_image.encode_for, "textract")
+            workspace.save(IMAGE_IMPROVED, improved_image.name, encoded.data)
+        return improved_image
 
-        images_list = pdf_to_image(file_path, image_preprocessed_folder)
-    else:
+    async def process_page(image, text_corpus_pdf="") -> list:
         """
-        If the file is an image, process it as an image.
+        Improves a page and extracts its text with the OCR backend policy.
         """
-        images_list = process_images(file_path, image_preprocessed_folder)
-
-    # Itera sobre las paginas del documento y mejoramos la calidad
-    for image in images_list:
-        image_path = os.path.join(image_preprocessed_folder, image)
-        improve_image_quality(image_path, image_improved_folder)
+        improved_image = await improve_page(image)
+        text_corpus_ocr, docConfidence, hasManuscript, ocr_blocks = await extract_page_text(improved_image)
+        # Los bloques del OCR quedan con la pagina, su geometria es relativa a esta imagen
+        improved_image.ocr_blocks = ocr_blocks
 
-    # Crea lista de imagenes mejoradas
-    improved_images_list = FileUtils.create_list(image_improved_folder)
-    # Crea variable para multiples paginas en un documento
-    all_text_corpus = []
-    # Itera sobre la imagenes mejoradas y aplica OCR
-    for improved_image in improved_images_list:
-        improved_image_path = os.path.join(image_improved_folder, improved_image)
-        
-        text_corpus_ocr, docConfidence, hasManuscript = extract_text_from_image(improved_image_path)
-       
         text_corpus = text_corpus_ocr
-        
+
         if len(text_corpus) < len(text_corpus_pdf):
             text_corpus = text_corpus_pdf
             docConfidence = 100
-        
-        if len(improved_images_list) == 1:
-            return text_corpus, docConfidence, hasManuscript, improved_image_path
-        else:
-            all_text_corpus.append([text_corpus, docConfidence, hasManuscript, improved_image_path])
-    return all_text_corpus, None, False, None
\ No newline at end of file
+        # Las paginas que se extraen solo con texto no necesitan conservar la imagen
+        if needs_image is not None and not needs_image(text_corpus, docConfidence, hasManuscript):
+            improved_image.release()
+        return [text_corpus, docConfidence, hasManuscript, improved_image]
+
+    if filetype == "pdf":
+        """
+        If the file is a PDF, use the text layer of the pages that have a clean one and
+        only rasterize and OCR the rest. Pages are rendered one at a time when their turn
+        comes, so the first page is processed while the next ones are still pending and
+        the memory used does not grow with the number of pages. Pages using the text layer
+        are rasterized later only if the vision extraction needs them, as are the pages
+        read with the Textract document mode.
+        """
+        # El PDF se analiza una sola vez por solicitud, su archivo temporal se borra al terminar
+        # la solicitud (las paginas diferidas se pueden rasterizar hasta la extraccion)
+        pdf_document = workspace.close_on_cleanup(PdfDocument(file_bytes, file_name, dpi=pdf_dpi(doctype)))
+        try:
+            pages_text = await run_cpu_bound(pdf_document.pages_text)
+        except Exception as e:
+            print(f"Failed to read the PDF text layer of {file_name}. Reason: {e}")
+            try:
+                pages_text = [""] * await run_cpu_bound(lambda: pdf_document.page_count)
+            except Exception as e:
+                print("Error in convert_pdf_to_image", e)
+                pages_text = []
+
+        if not pages_text:
+            raise ValueError(f"No fue posible leer el documento {file_name}.")
+
+        # Con el modo documento de Textract, las paginas sin texto usable se leen con un solo trabajo
+        pages_ocr = None
+        ocr_page_count = sum(1 for page_text in pages_text if not page_text_is_usable(page_text))
+        if use_document_mode(ocr_page_count):
+            try:
+                pages_ocr = await extract_text_from_pdf(file_bytes, len(pages_text))
+            except Exception as e:
+                print(f"Textract document mode failed for {file_name}, OCR page by page. Reason: {e}")
+
+        async def process_pdf_page(page_number) -> list:
+            page_text = pages_text[page_number]
+
+            async def load_page_image():
+                image = await run_cpu_bound(pdf_document.rasterize, page_number)
+                return await improve_page(image)
+
+            image_name = pdf_document.page_name(page_number)
+            if page_text_is_usable(page_text):
+                print(f"Using the PDF text layer of {image_name}, OCR skipped")
+                return [page_text, 100, False, LazyPageImage(image_name, load_page_image)]
+            if pages_ocr is not None:
+                text_corpus, docConfidence, hasManuscript = pages_ocr[page_number]
+                if len(text_corpus) < len(page_text):
+                    text_corpus = page_text
+                    docConfidence = 100
+                return [text_corpus, docConfidence, hasManuscript, LazyPageImage(image_name, load_page_image)]
+            image = await run_cpu_bound(pdf_document.rasterize, page_number)
+            return await process_page(image, page_text)
+
+        # Procesamos las paginas en paralelo, conservando su orden
+        all_text_corpus = await map_pages(process_pdf_page, range(len(pages_text)))
+    else:
+        """
+        If the file is an image, process it as an image.
+        """
+        images_list = await run_cpu_bound(process_images, file_bytes, file_name)
+        # Mejoramos la calidad y aplicamos OCR a las paginas en paralelo, conservando su orden
+        all_text_corpus = await map_pages(process_page, images_list)
+
+    if len(all_text_corpus) == 1:
+        return tuple(all_text_corpus[0])
+    return all_text_corpus, None, False, None
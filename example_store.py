@@ -0,0 +1,412 @@
+# %% Few-shot example store
+
+from dataclasses import dataclass
+from google.genai import types
+from utils.file_utils import FileUtils
+from utils.general_utils import Utils
+from dotenv import load_dotenv
+import numpy as np
+import PIL.Image
+import threading
+import math
+import re
+import cv2
+import os
+
+"""
+Process-wide cache of the few-shot examples used as context for the models.
+
+The examples in 'image_inject/<doctype>' are read and decoded only once per
+doc type and kept in memory in the form they are sent to Gemini, and the
+developer prompt built from 'data_inject/<doctype>' is compiled once per doc
+type. Every lookup compares the mtime/size of the files on disk with the ones
+used to build the cache, so adding, editing or deleting an example reloads
+that doc type only. The lookups stat every example file and may reload them,
+so the async pipeline calls them with run_blocking, outside the event loop.
+
+Only the examples closest to the incoming page are sent to Gemini: each example
+image has a perceptual hash computed when it is loaded, and the examples are
+taken by similarity to the improved page, up to k per doc type
+(VISION_EXAMPLES_K_<TYPE>) and within VISION_TOKEN_BUDGET input tokens.
+"""
+
+load_dotenv()
+
+# Profundidad de subcarpetas por tipo de documento
+EXAMPLES_DEPTH = {"IMSS": 2, "INFONAVIT": 2, "SAT": 1}
+
+# Formato de salida JSON por tipo de documento
+OUTPUT_FORMATS = {
+    "IMSS": '{"serie_y_folio": "string", "tipo_incapacidad": "string", "ramo_de_seguro": "string", "probable_riesgo_trabajo": "string", "dias_autorizados": "string", "fecha_a_partir": "date (DD/MM/YYYY)", "fecha_expedido": "date (DD/MM/YYYY)", "numero_de_seguridad_social": "string", "curp": "string", "nombre_del_asegurado": "string", "clave_patronal": "string", "nombre_del_patron": "string"}',
+    "INFONAVIT": '{"titulo": "string", "motivo": "ALTA|SUSPENSION", "folio": "string", "fecha_notificacion": "date (DD/MM/YYYY)", "fecha_emision": "date (DD/MM/YYYY)", "fecha_tramite": "date (DD/MM/YYYY)", "fecha_recepcion": "date (DD/MM/YYYY)", "numero_de_credito": "string", "descuento": "oneOf": "[{"cantidad": "string"}, {"porcentaje": "string"}, {"factor": "string"}]", "rfc": "string", "numero_de_seguridad_social": "string", "rfc_patron": "string", "numero_de_registro_patronal": "string", "razon_social": "string", "sello_de_la_empresa": "true|false", "leyenda_aplicacion_descuento": "string"}',
+    "SAT": '{"codigo_postal": "number", "curp": "string", "nombres": "string", "primer_apellido": "string", "segundo_apellido": "string", "rfc": "string", "estatus_en_el_padron": "string"}',
+}
+
+# Numero maximo de ejemplos de vision por tipo de documento
+VISION_EXAMPLES_K = {
+    doctype: int(os.environ.get(f"VISION_EXAMPLES_K_{doctype}", default))
+    for doctype, default in {"IMSS": 4, "INFONAVIT": 4, "SAT": 2}.items()
+}
+# Tokens de entrada maximos para los ejemplos (imagenes y resultados) de una llamada de vision
+VISION_TOKEN_BUDGET = int(os.environ.get("VISION_TOKEN_BUDGET", 8000))
+# Gemini cobra 258 tokens por imagen pequena o por cada bloque de 768x768
+GEMINI_TOKENS_PER_TILE = 258
+GEMINI_TILE_SIZE = 768
+# Lado del hash perceptual (FINGERPRINT_SIZE^2 bits)
+FINGERPRINT_SIZE = 16
+
+# Modelo usado para contar los tokens del prompt de Chat Completions
+CHAT_MODEL = "gpt-4o-mini"
+# Modelo de Gemini de las extracciones de vision
+VISION_MODEL = "gemini-2.0-flash-lite"
+
+_lock = threading.Lock()
+_vision_examples = {}
+_chat_prompts = {}
+
+
+@dataclass(frozen=True)
+class VisionExamples:
+    """
+    Few-shot examples of a doc type ready to be appended to a Gemini request.
+        Attributes:
+            doc_type: Type of document (IMSS, INFONAVIT, SAT).
+            images: Example images as upload-ready parts.
+            image_names: File names of the example images, in the same order.
+            results: Expected JSON output of each example image, in the same order.
+            fingerprints: Perceptual hash of each example image, in the same order.
+            token_costs: Estimated input tokens of each example (image and result), in the same order.
+            signature: mtime/size snapshot of the files used to build the examples.
+    """
+
+    doc_type: str
+    images: tuple
+    image_names: tuple
+    results: tuple
+    fingerprints: tuple
+    token_costs: tuple
+    signature: tuple
+
+
+@dataclass(frozen=True)
+class CompiledPrompt:
+    """
+    Developer prompt of a doc type, compiled once and reused byte for byte on every
+    request so the provider prompt-prefix cache can hit.
+        Attributes:
+            doc_type: Type of document (IMSS, INFONAVIT, SAT).
+            sub_type: Subfolder whose examples are in the prompt, None if it has every example of the doc type.
+            content: Text of the developer message.
+            num_tokens: Tokens of the developer message counted with Utils.num_tokens_from_messages (None if they could not be counted).
+            signature: mtime/size snapshot of the files used to build the prompt.
+    """
+
+    doc_type: str
+    sub_type: str
+    content: str
+    num_tokens: int
+    signature: tuple
+
+    def message(self) -> dict:
+        """
+        Returns the developer message to send as the first message of the chat.
+        """
+        return {"role": "developer", "content": self.content}
+
+
+def get_example_files(inject_folder, doctype, sub_type=None) -> list:
+    """
+    Returns the sorted list of example files of a doc type, or only of one of its
+    sub-types (subfolders) if sub_type is given.
+    Sorting keeps the pairing example/result stable between calls and hosts.
+    """
+    if doctype not in EXAMPLES_DEPTH:
+        raise ValueError(
+            "Tipo de documento no reconozido. Por favor, proporcione un tipo de documento válido: IMSS, INFONAVIT, SAT"
+        )
+    sub_folder = os.path.join(inject_folder, doctype)
+    if sub_type is not None:
+        return sorted(FileUtils.get_paths(os.path.join(sub_folder, sub_type), 1))
+    return sorted(FileUtils.get_paths(sub_folder, EXAMPLES_DEPTH[doctype]))
+
+
+def get_sub_types(inject_folder, doctype) -> list:
+    """
+    Returns the sorted subfolders of a doc type, empty if its examples have no subfolders.
+    """
+    if EXAMPLES_DEPTH.get(doctype, 1) < 2:
+        return []
+    sub_folder = os.path.join(inject_folder, doctype)
+    return sorted(
+        name for name in os.listdir(sub_folder) if os.path.isdir(os.path.join(sub_folder, name))
+    )
+
+
+def pair_example_files(file_paths) -> list:
+    """
+    Pairs each example image with its result file. In a folder whose images are numbered
+    (image_3_...), each image goes with the result of the same number (result_3_...); in a
+    folder with unnumbered images, images and results are paired in name order. Files
+    without a match are reported and skipped.
+        Returns:
+            list: (image_file, result_file) tuples.
+    """
+    folders = {}
+    for file in file_paths:
+        file_name = os.path.basename(file)
+        match = re.match(r"(image|result)_(?:(\d+)_)?", file_name)
+        if match is None:
+            print(f"Documento: {file} no reconozido.")
+            continue
+        folder = folders.setdefault(os.path.dirname(file), {"image": [], "result": []})
+        number = int(match.group(2)) if match.group(2) else None
+        folder[match.group(1)].append((number, file))
+
+    pairs = []
+    for folder in sorted(folders):
+        images = sorted(folders[folder]["image"], key=lambda item: (item[0] or 0, item[1]))
+        results = sorted(folders[folder]["result"], key=lambda item: (item[0] or 0, item[1]))
+        if images and all(number is not None for number, _ in images):
+            results_by_number = {number: file for number, file in results}
+            folder_pairs = [
+                (file, results_by_number[number]) for number, file in images if number in results_by_number
+            ]
+        else:
+            folder_pairs = list(zip([file for _, file in images], [file for _, file in results]))
+        paired = {file for pair in folder_pairs for file in pair}
+        for _, file in images + results:
+            if file not in paired:
+                print(f"Example {file} has no matching image/result file, skipped")
+        pairs += folder_pairs
+    return pairs
+
+
+def files_signature(file_paths) -> tuple:
+    """
+    Snapshot (path, mtime, size) of a list of files, used to detect changes on disk.
+    """
+    signature = []
+    for file_path in file_paths:
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            continue
+        signature.append((file_path, stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+def load_image_part(file_path) -> types.Part:
+    """
+    Reads an example image and returns it as an inline part with its original bytes,
+    so the image is never re-encoded before being sent.
+    """
+    with PIL.Image.open(file_path) as image:
+        image.verify()
+        mime_type = PIL.Image.MIME.get(image.format, "image/jpeg")
+    with open(file_path, "rb") as file:
+        data = file.read()
+    return types.Part.from_bytes(data=data, mime_type=mime_type)
+
+
+def image_fingerprint(image) -> np.ndarray:
+    """
+    Difference hash of an image: the grayscale image reduced to FINGERPRINT_SIZE rows
+    and compared column by column, so it captures the layout of the page and not its
+    resolution, colors or compression.
+    """
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(
+        image, (FINGERPRINT_SIZE + 1, FINGERPRINT_SIZE), interpolation=cv2.INTER_AREA
+    )
+    return (small[:, 1:] > small[:, :-1]).ravel()
+
+
+def image_token_cost(width, height) -> int:
+    """
+    Estimated Gemini input tokens of an image of the given size.
+    """
+    if width <= 384 and height <= 384:
+        return GEMINI_TOKENS_PER_TILE
+    tiles = math.ceil(width / GEMINI_TILE_SIZE) * math.ceil(height / GEMINI_TILE_SIZE)
+    return tiles * GEMINI_TOKENS_PER_TILE
+
+
+def select_vision_examples(
+    examples, page_array, k=None, token_budget=VISION_TOKEN_BUDGET
+) -> VisionExamples:
+    """
+    Selects the examples most similar to the page, nearest first.
+        Args:
+            examples: All the vision examples of the doc type.
+            page_array: Improved page raster.
+            k: Maximum number of examples, VISION_EXAMPLES_K of the doc type by default.
+            token_budget: Maximum estimated input tokens of the selected examples.
+        Returns:
+            VisionExamples: The selected examples, at least one if there is any.
+    """
+    if k is None:
+        k = VISION_EXAMPLES_K.get(examples.doc_type, len(examples.images))
+    page_fingerprint = image_fingerprint(page_array)
+    distances = [
+        np.count_nonzero(fingerprint != page_fingerprint)
+        for fingerprint in examples.fingerprints
+    ]
+    selected = []
+    tokens = 0
+    for idx in np.argsort(distances, kind="stable"):
+        if len(selected) >= k:
+            break
+        if selected and tokens + examples.token_costs[idx] > token_budget:
+            continue
+        selected.append(idx)
+        tokens += examples.token_costs[idx]
+    print(
+        f"Selected {len(selected)} of {len(examples.images)} vision examples for {examples.doc_type} (~{tokens} tokens)"
+    )
+    return VisionExamples(
+        doc_type=examples.doc_type,
+        images=tuple(examples.images[idx] for idx in selected),
+        image_names=tuple(examples.image_names[idx] for idx in selected),
+        results=tuple(examples.results[idx] for idx in selected),
+        fingerprints=tuple(examples.fingerprints[idx] for idx in selected),
+        token_costs=tuple(examples.token_costs[idx] for idx in selected),
+        signature=examples.signature,
+    )
+
+
+def get_vision_examples(image_inject_folder, doctype) -> VisionExamples:
+    """
+    Returns the cached vision examples of a doc type, loading them if they are
+    not cached yet or if any file in the example folder changed.
+        Args:
+            image_inject_folder: The folder path of the context images.
+            doctype: Type of document (IMSS, INFONAVIT, SAT).
+        Returns:
+            VisionExamples: Immutable examples ready to be sent.
+    """
+    signature = files_signature(get_example_files(image_inject_folder, doctype))
+    key = (image_inject_folder, doctype)
+    cached = _vision_examples.get(key)
+    if cached is not None and cached.signature == signature:
+        return cached
+
+    with _lock:
+        cached = _vision_examples.get(key)
+        if cached is not None and cached.signature == signature:
+            return cached
+
+        images = []
+        image_names = []
+        results = []
+        fingerprints = []
+        token_costs = []
+        # Cada imagen va con su resultado, las listas quedan alineadas por posicion
+        for image_file, result_file in pair_example_files([file for file, _, _ in signature]):
+            result = FileUtils.read(result_file)
+            results.append(result)
+            images.append(load_image_part(image_file))
+            image_names.append(os.path.basename(image_file))
+            # Huella y costo de la imagen calculados una sola vez al cargar el ejemplo
+            gray = cv2.imread(image_file, cv2.IMREAD_GRAYSCALE)
+            fingerprints.append(image_fingerprint(gray))
+            # Los resultados se estiman a 4 caracteres por token
+            token_costs.append(image_token_cost(gray.shape[1], gray.shape[0]) + len(result) // 4)
+
+        examples = VisionExamples(
+            doc_type=doctype,
+            images=tuple(images),
+            image_names=tuple(image_names),
+            results=tuple(results),
+            fingerprints=tuple(fingerprints),
+            token_costs=tuple(token_costs),
+            signature=signature,
+        )
+        _vision_examples[key] = examples
+        print(f"Loaded {len(images)} vision examples for {doctype}")
+        return examples
+
+
+def compile_chat_prompt(doctype, data_files) -> str:
+    """
+    Builds the developer prompt of a doc type from its raw text/result examples.
+    """
+    input_results_list = []
+    input_txt_list = []
+    for file in data_files:
+        file_name = os.path.basename(file)
+        if file_name.startswith("result"):
+            input_results_list.append(FileUtils.read(file))
+        elif file_name.startswith("data"):
+            input_txt_list.append(FileUtils.read(file))
+        else:
+            print(f"File {file} not recognized")
+
+    context_parts = [
+        f"Your role is to extract relevant information from raw text. In between XML tags you will find {len(input_txt_list)} examples of raw text inputs and information extracted outputs with the relevant entities to be recognized. \n\n"
+    ]
+    for count, (input_txt, input_result) in enumerate(
+        zip(input_txt_list, input_results_list), start=1
+    ):
+        context_parts.append(
+            f"<raw_text_input_example_{count}>\n\n{input_txt}\n\n</raw_text_input_example_{count}>\n\n<information_extracted_output_example_{count}>\n\n{input_result}\n\n</information_extracted_output_example_{count}>\n\n"
+        )
+    context_parts.append(
+        "\nYou will recive a new raw text by the user. Your task is to analyse the raw text, recognize the entities to be extracted, and create a JSON with the relevant entities. Use the following format for the output JSON:\n\n"
+    )
+    context_parts.append(OUTPUT_FORMATS[doctype])
+    return "".join(context_parts)
+
+
+def get_chat_prompt(data_inject_folder, doctype, sub_type=None) -> CompiledPrompt:
+    """
+    Returns the compiled developer prompt of a doc type, rebuilding it if it is not
+    cached yet or if any file in the example folder changed.
+        Args:
+            data_inject_folder: The folder path of the context data.
+            doctype: Type of document (IMSS, INFONAVIT, SAT).
+            sub_type: Subfolder to take the examples from, None to use every example.
+        Returns:
+            CompiledPrompt: Immutable developer prompt with its token count.
+    """
+    signature = files_signature(get_example_files(data_inject_folder, doctype, sub_type))
+    key = (data_inject_folder, doctype, sub_type)
+    cached = _chat_prompts.get(key)
+    if cached is not None and cached.signature == signature:
+        return cached
+
+    with _lock:
+        cached = _chat_prompts.get(key)
+        if cached is not None and cached.signature == signature:
+            return cached
+
+        content = compile_chat_prompt(doctype, [file for file, _, _ in signature])
+        try:
+            num_tokens = Utils.num_tokens_from_messages(
+                [{"role": "developer", "content": content}], model=CHAT_MODEL
+            )
+        except Exception as e:
+            # El conteo es informativo, no debe impedir procesar documentos
+            print(f"Failed to count prompt tokens for {doctype}. Reason: {e}")
+            num_tokens = None
+        prompt = CompiledPrompt(
+            doc_type=doctype,
+            sub_type=sub_type,
+            content=content,
+            num_tokens=num_tokens,
+            signature=signature,
+        )
+        _chat_prompts[key] = prompt
+        print(f"Compiled chat prompt for {os.path.join(doctype, sub_type or '')}: {num_tokens} tokens")
+        return prompt
+
+
+def preload(image_inject_folder, data_inject_folder) -> None:
+    """
+    Loads the examples and prompts of every doc type, so the first requests don't pay for it.
+    """
+    for doctype in EXAMPLES_DEPTH:
+        get_vision_examples(image_inject_folder, doctype)
+        get_chat_prompt(data_inject_folder, doctype)
+        for sub_type in get_sub_types(data_inject_folder, doctype):
+            get_chat_prompt(data_inject_folder, doctype, sub_type)
@@ -0,0 +1,222 @@
+# %% Executors for blocking work
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+from dotenv import load_dotenv
+import numpy as np
+import multiprocessing
+import functools
+import threading
+import asyncio
+import os
+
+"""
+Bounded executors used by the async pipeline so the event loop never runs
+blocking work inline.
+
+- IMAGE_WORKERS: threads for CPU-bound image steps (OpenCV, numpy, pdf2image
+  and PyPDF2). OpenCV releases the GIL, so threads use several cores.
+- IO_WORKERS: threads for blocking network clients without an async API (boto3).
+- IMAGE_PROCESSES: processes for the page improvement, which is pure CPU work.
+  Page rasters are passed to and from the processes through shared memory
+  instead of being pickled.
+- IMAGE_QUEUE_SIZE: pages submitted to the process pool at the same time. When the
+  pool is saturated, new pages wait before their raster is copied to shared memory.
+- PAGE_CONCURRENCY / GLOBAL_PAGE_CONCURRENCY: pages of one document, and of all
+  the documents of the process, that are processed at the same time.
+"""
+
+load_dotenv()
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", os.cpu_count() or 1))
+IO_WORKERS = int(os.environ.get("IO_WORKERS", 32))
+IMAGE_PROCESSES = int(os.environ.get("IMAGE_PROCESSES", os.cpu_count() or 1))
+IMAGE_QUEUE_SIZE = int(os.environ.get("IMAGE_QUEUE_SIZE", IMAGE_PROCESSES * 2))
+PAGE_CONCURRENCY = int(os.environ.get("PAGE_CONCURRENCY", 4))
+GLOBAL_PAGE_CONCURRENCY = int(os.environ.get("GLOBAL_PAGE_CONCURRENCY", 32))
+
+_image_executor = ThreadPoolExecutor(
+    max_workers=IMAGE_WORKERS, thread_name_prefix="image_worker"
+)
+_io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io_worker")
+# El pool de procesos se crea en el primer uso, no al importar el modulo
+_process_executor = None
+_process_executor_lock = threading.Lock()
+_global_page_semaphore = asyncio.Semaphore(GLOBAL_PAGE_CONCURRENCY)
+_image_process_semaphore = asyncio.Semaphore(IMAGE_QUEUE_SIZE)
+
+
+def get_process_executor() -> ProcessPoolExecutor:
+    """
+    Returns the process pool used for page improvement, creating it on first use.
+    """
+    global _process_executor
+    if _process_executor is None:
+        with _process_executor_lock:
+            if _process_executor is None:
+                # spawn evita heredar los hilos y el event loop del proceso principal
+                _process_executor = ProcessPoolExecutor(
+                    max_workers=IMAGE_PROCESSES,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+    return _process_executor
+
+
+async def run_cpu_bound(func, *args, **kwargs):
+    """
+    Runs a CPU-bound function in the image executor and awaits its result.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _image_executor, functools.partial(func, *args, **kwargs)
+    )
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Runs a blocking I/O function in the I/O executor and awaits its result.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _io_executor, functools.partial(func, *args, **kwargs)
+    )
+
+
+def _array_to_shared_memory(array) -> tuple:
+    """
+    Copies an array to a new shared memory block.
+        Returns:
+            tuple: The shared memory block and the (name, shape, dtype) used to attach to it.
+    """
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+
+def _array_from_shared_memory(descriptor) -> np.ndarray:
+    """
+    Copies the array of a shared memory block created by a worker and releases the block.
+    """
+    name, shape, dtype = descriptor
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        return np.ndarray(shape, dtype, buffer=block.buf).copy()
+    finally:
+        block.close()
+        block.unlink()
+
+
+def _release_shared_memory(descriptor):
+    """
+    Releases a shared memory block created by a worker without reading it.
+    """
+    block = shared_memory.SharedMemory(name=descriptor[0])
+    block.close()
+    block.unlink()
+
+
+def _run_on_shared_array(func, descriptor, args, kwargs) -> tuple:
+    """
+    Runs in a worker process: calls func on the array of the shared memory block and
+    writes an array result to a new block, which the parent process releases.
+    """
+    name, shape, dtype = descriptor
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        result = func(np.ndarray(shape, dtype, buffer=block.buf), *args, **kwargs)
+        if isinstance(result, np.ndarray):
+            result_block, result_descriptor = _array_to_shared_memory(result)
+            # El resultado puede ser una vista del bloque de entrada, se libera antes de cerrarlo
+            del result
+            result_block.close()
+            return "shared_memory", result_descriptor
+        return "value", result
+    finally:
+        block.close()
+
+
+async def run_in_image_process(func, array, *args, **kwargs):
+    """
+    Runs func(array, *args, **kwargs) in the process pool, passing the array and an
+    array result through shared memory. Waits while IMAGE_QUEUE_SIZE pages are already
+    submitted, so a burst of pages does not pile up rasters in memory.
+    If the caller is cancelled (e.g. map_pages cancels the pages of a failed document),
+    the worker keeps its slot until it finishes, and its blocks are released then.
+    """
+    loop = asyncio.get_running_loop()
+    await _image_process_semaphore.acquire()
+    try:
+        block, descriptor = _array_to_shared_memory(np.ascontiguousarray(array))
+    except BaseException:
+        _image_process_semaphore.release()
+        raise
+    try:
+        future = loop.run_in_executor(
+            get_process_executor(),
+            functools.partial(_run_on_shared_array, func, descriptor, args, kwargs),
+        )
+    except BaseException:
+        block.close()
+        block.unlink()
+        _image_process_semaphore.release()
+        raise
+
+    def release(future):
+        # El bloque de entrada y el lugar en la cola se liberan cuando el proceso termina
+        block.close()
+        block.unlink()
+        _image_process_semaphore.release()
+
+    future.add_done_callback(release)
+    try:
+        kind, result = await asyncio.shield(future)
+    except asyncio.CancelledError:
+        # Nadie va a leer el resultado, su bloque se libera cuando el proceso lo entregue
+        future.add_done_callback(_discard_result)
+        raise
+    if kind == "shared_memory":
+        return _array_from_shared_memory(result)
+    return result
+
+
+def _discard_result(future):
+    """
+    Releases the result block of a process pool call whose caller was cancelled.
+    """
+    if future.cancelled() or future.exception() is not None:
+        return
+    kind, result = future.result()
+    if kind == "shared_memory":
+        _release_shared_memory(result)
+
+
+async def map_pages(func, pages, limit=PAGE_CONCURRENCY) -> list:
+    """
+    Runs the coroutine function func over every page concurrently, bounded by the
+    per-document limit and by the global page limit of the process. When a page fails,
+    the pages still running or waiting are cancelled, so they stop calling the external
+    services, and the error of the page is raised.
+        Returns:
+            list: The results in the same order as pages.
+    """
+    document_semaphore = asyncio.Semaphore(limit)
+
+    async def run(page):
+        async with document_semaphore:
+            async with _global_page_semaphore:
+                return await func(page)
+
+    tasks = [asyncio.create_task(run(page)) for page in pages]
+    if not tasks:
+        return []
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        # Cancelamos las paginas pendientes, tambien si se cancela la solicitud
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    for task in tasks:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+    return [task.result() for task in tasks]
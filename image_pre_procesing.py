@@ -2,11 +2,18 @@
 
 from PyPDF2 import PdfReader
 from PIL import Image
-from utils.file_utils import FileUtils
-from pdf2image import convert_from_path
+from pdf2image import pdfinfo_from_path
+from page_image import PageImage
+from dotenv import load_dotenv
+from io import BytesIO
+import numpy as np
+import cv2
+import subprocess
+import threading
+import tempfile
+import weakref
 import re
 import os
-import shutil
 
 """
 INSTALLATION:
@@ -26,74 +33,184 @@ POTENTIAL IMPROVEMENTS
 """
 
 
-def pdf_has_text(file_path, string_threshold=200):
-    # Extract text
-    text_corpus = get_text_from_pdf(file_path)
-    # Clean the text
+load_dotenv()
+# Minimo de caracteres y proporcion de caracteres legibles para usar la capa de texto de una pagina
+PDF_TEXT_MIN_CHARS = int(os.environ.get("PDF_TEXT_MIN_CHARS", 200))
+PDF_TEXT_CLEAN_RATIO = float(os.environ.get("PDF_TEXT_CLEAN_RATIO", 0.85))
+READABLE_PUNCTUATION = set(".,:;-_/()[]$%#°'\"*&@+")
+# Resolucion de rasterizado de los PDF, configurable por tipo de documento (PDF_DPI_IMSS, ...)
+PDF_DPI = int(os.environ.get("PDF_DPI", 200))
+PDF_DPI_BY_DOCTYPE = {
+    doctype: int(os.environ.get(f"PDF_DPI_{doctype}", PDF_DPI))
+    for doctype in ("IMSS", "INFONAVIT", "SAT")
+}
+# La mejora de imagen trabaja en escala de grises, rasterizar en gris reduce la memoria a un tercio
+PDF_GRAYSCALE = os.environ.get("PDF_GRAYSCALE", "true").lower() in ("1", "true", "yes")
+
+
+def pdf_dpi(doctype) -> int:
+    """
+    Returns the rasterization DPI of a document type
+    """
+    return PDF_DPI_BY_DOCTYPE.get(doctype, PDF_DPI)
+
+
+def clean_pdf_text(text_corpus) -> str:
+    """
+    Removes line breaks and the CamScanner watermark from the PDF text layer
+    """
     regex_cleaning_list = [r"\n", r"Escaneado con CamScanner"]
     for ii in range(len(regex_cleaning_list)):
         regex_pattern = regex_cleaning_list[ii]
         text_corpus = re.sub(regex_pattern, "", text_corpus)
-    # If the length of the string is cero
-    if len(text_corpus) > string_threshold:
-        return True
-    else:
-        return False
+    return text_corpus
 
 
-def process_images(file_path, output_folder_path) -> None:
+class PdfDocument:
     """
-    Function to process images from a PDF file
+    A PDF file parsed once per request. The text layer of every page is read with a
+    single PdfReader and cached, and pages are rasterized one at a time on demand.
+    The file is written once to a temporary path that poppler reads for every page;
+    the path is deleted with close() or when the document is garbage collected.
+        Args:
+            file_bytes: Content of the PDF file.
+            file_name: Name of the PDF file, used to name the page images.
+            dpi: Rasterization resolution.
+            grayscale: Rasterize the pages in grayscale instead of BGR.
     """
 
-    file_name_procesed = f"{os.path.basename(file_path)}_procesed"
-
-    with Image.open(file_path) as img:
-        image_format = img.format
-        image_format = image_format.lower()
+    def __init__(self, file_bytes=bytes, file_name=str, dpi=PDF_DPI, grayscale=PDF_GRAYSCALE):
+        self.file_bytes = file_bytes
+        self.file_name = os.path.basename(file_name)
+        self.dpi = dpi
+        self.grayscale = grayscale
+        self.name = re.sub(r"\.pdf$", "", self.file_name, flags=re.IGNORECASE)
+        self._reader = None
+        self._pages_text = None
+        self._page_count = None
+        self._path = None
+        self._finalizer = None
+        self._lock = threading.Lock()
+
+    def _get_reader(self) -> PdfReader:
+        if self._reader is None:
+            self._reader = PdfReader(BytesIO(self.file_bytes))
+        return self._reader
+
+    def _get_path(self) -> str:
+        """
+        Writes the PDF to a temporary file on first use and returns its path.
+        """
+        with self._lock:
+            if self._path is None:
+                file_descriptor, path = tempfile.mkstemp(suffix=".pdf")
+                with os.fdopen(file_descriptor, "wb") as file:
+                    file.write(self.file_bytes)
+                self._path = path
+                self._finalizer = weakref.finalize(self, _remove_file, path)
+            return self._path
+
+    def close(self):
+        """
+        Deletes the temporary file of the PDF, if it was written.
+        """
+        if self._finalizer is not None:
+            self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
 
-    file_name_procesed_image = file_name_procesed + "." + image_format
+    @property
+    def page_count(self) -> int:
+        """
+        Number of pages, read by poppler if PyPDF2 can not parse the file. Read once.
+        """
+        if self._page_count is None:
+            try:
+                with self._lock:
+                    self._page_count = len(self._get_reader().pages)
+            except Exception as e:
+                print(f"PyPDF2 could not read {self.file_name}, using pdfinfo. Reason: {e}")
+                self._page_count = int(pdfinfo_from_path(self._get_path())["Pages"])
+        return self._page_count
+
+    def pages_text(self) -> list:
+        """
+        Returns the text layer of every page, extracted on first use.
+        """
+        with self._lock:
+            if self._pages_text is None:
+                self._pages_text = [
+                    page.extract_text() or "" for page in self._get_reader().pages
+                ]
+        return list(self._pages_text)
+
+    def page_name(self, page_number) -> str:
+        return self.name + " page" + str(page_number) + ".jpeg"
+
+    def rasterize(self, page_number) -> PageImage:
+        """
+        Rasterizes a single page of the PDF file (page_number starts at 0). pdftoppm
+        reads the temporary file of the document and writes the page to stdout, without
+        the pdfinfo call and the copy of the file that convert_from_bytes makes per page.
+        """
+        args = ["pdftoppm", "-r", str(self.dpi), "-f", str(page_number + 1), "-l", str(page_number + 1), "-singlefile"]
+        if self.grayscale:
+            args.append("-gray")
+        args.append(self._get_path())
+        result = subprocess.run(args, capture_output=True)
+        if result.returncode != 0 or not result.stdout:
+            raise ValueError(
+                f"No fue posible rasterizar la pagina {page_number + 1} de {self.file_name}: "
+                f"{result.stderr.decode(errors='ignore').strip()}"
+            )
+        with Image.open(BytesIO(result.stdout)) as page:
+            if self.grayscale:
+                image = np.array(page.convert("L"))
+            else:
+                image = cv2.cvtColor(np.array(page.convert("RGB")), cv2.COLOR_RGB2BGR)
+        return PageImage(self.page_name(page_number), image, "jpeg")
 
-    # Build the full source and target paths
-    target_path = os.path.join(output_folder_path, file_name_procesed_image)
 
-    # Copy the image to the target folder with the new name
-    shutil.copy2(file_path, target_path)
-    procesed_images_list = FileUtils.create_list(output_folder_path)
-    return procesed_images_list
+def _remove_file(path):
+    if os.path.exists(path):
+        os.remove(path)
 
 
-# Define function to extract text
-def get_text_from_pdf(file_path=str) -> str:
+def page_text_is_usable(
+    text_corpus, string_threshold=PDF_TEXT_MIN_CHARS, clean_ratio=PDF_TEXT_CLEAN_RATIO
+) -> bool:
     """
-    Function to extract text from a PDF file"""
-    # Initialize a PDF reader object and read the PDF
-    reader = PdfReader(file_path)
-
-    # Initialize an empty string to hold all the text
-    text_corpus = ""
+    Checks if the text layer of a page is long and clean enough to skip OCR.
+    Broken font encodings produce text full of symbols, which fails the readable ratio.
+    """
+    text_corpus = clean_pdf_text(text_corpus)
+    if len(text_corpus) <= string_threshold or "(cid:" in text_corpus:
+        return False
+    readable = sum(
+        1 for char in text_corpus
+        if char.isalnum() or char.isspace() or char in READABLE_PUNCTUATION
+    )
+    return readable / len(text_corpus) >= clean_ratio
 
-    # Iterate through each page in the PDF and extract text
-    for page in reader.pages:
-        text_corpus += page.extract_text() + "\n"  # Adding a newline character
 
-    return text_corpus
+def process_images(file_bytes, file_name) -> list:
+    """
+    Function to decode an uploaded image into an in-memory page
+    """
 
+    file_name_procesed = f"{os.path.basename(file_name)}_procesed"
 
-def pdf_to_image(input_file, output_folder_path) -> list:
-    filename = os.path.basename(input_file).strip(".pdf")
+    with Image.open(BytesIO(file_bytes)) as img:
+        image_format = img.format
+        image_format = image_format.lower()
 
-    # Store Pdf with convert_from_path function
-    try:
-        images = convert_from_path(input_file)
-        # Save pages as images in the pdf
-        for i in range(len(images)):
-            output_path = (
-                output_folder_path + "/" + filename + " page" + str(i) + ".jpeg"
-            )
-            images[i].save(output_path, "JPEG")
-            images_in_pdf = FileUtils.create_list(output_folder_path)
-        return images_in_pdf
+    file_name_procesed_image = file_name_procesed + "." + image_format
 
-    except Exception as e:
-        print("Error in convert_pdf_to_image", e)
+    # Decode the image as BGR, the same as cv2.imread
+    image = cv2.imdecode(np.frombuffer(file_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+    return [PageImage(file_name_procesed_image, image, image_format)]
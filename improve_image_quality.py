@@ -1,58 +1,76 @@
-import os
-from PIL import Image
 import numpy as np
 import cv2
 import math
 from typing import Tuple, Union
 from deskew import determine_skew
 from skimage import io, filters
+from dotenv import load_dotenv
+import os
 
 """
     Additional documentation:
     https://www.leadtools.com/help/sdk/v21/main/api/deskewing.html
 """
 
+load_dotenv()
 debug = True
+# Dimension maxima de la copia usada para calcular el recorte del texto (una carta a 200 DPI cabe completa)
+ANALYSIS_MAX_DIM = int(os.environ.get("ANALYSIS_MAX_DIM", 2200))
+# Dimension maxima de la copia usada para estimar la inclinacion
+SKEW_MAX_DIM = int(os.environ.get("SKEW_MAX_DIM", 1024))
+# Inclinacion minima (grados) a partir de la cual se rota la imagen
+SKEW_MIN_ANGLE = float(os.environ.get("SKEW_MIN_ANGLE", 0.5))
+
+
+def to_grayscale(image) -> np.ndarray:
+    """
+    Returns the image in grayscale, pages rasterized in grayscale are returned as they are
+    """
+    if image.ndim == 2:
+        return image
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
 
+def get_analysis_image(gray, max_dim=ANALYSIS_MAX_DIM) -> tuple:
+    """
+    Downscales the image so its largest side is at most max_dim
+    return the analysis image and its scale with respect to the original
+    rtype: tuple
+    """
+    scale = max_dim / max(gray.shape[:2])
+    if scale >= 1:
+        return gray, 1.0
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    # Escala real despues del redondeo del tamano
+    return small, small.shape[1] / gray.shape[1]
 
-def get_skew_angle(cvImage) -> float:
+
+def get_skew_angle(cvImage, max_dim=SKEW_MAX_DIM) -> float:
     """ "
-    Get the skew angle of the image using Hough Transform
-    return the average angle of the lines in the image
+    Get the skew angle of the image with deskew on a downscaled grayscale copy.
+    The angle does not depend on the scale, so the estimate is the same as on the
+    full resolution image at a fraction of the cost.
+    return the skew angle in degrees, None if it can not be estimated
     rtype: float
     """
-    # Convert the image to grayscale
-    gray = cv2.cvtColor(cvImage, cv2.COLOR_BGR2GRAY)
-    blur = cv2.GaussianBlur(gray, (9, 9), 0)
-    edges = cv2.Canny(blur, 50, 150, apertureSize=3)
-    lines = cv2.HoughLinesP(
-        edges, 1, np.pi / 180, 100, minLineLength=10, maxLineGap=250
-    )
-    angles = []
-    # calculate the angle of each line
-    if lines is not None:
-        for line in lines:
-            x1, y1, x2, y2 = line[0]
-            angle = np.arctan2(y2 - y1, x2 - x1) * 180.0 / np.pi
-            angles.append(angle)
-
-    # return the average angle
-    if not angles:
+    gray, _ = get_analysis_image(to_grayscale(cvImage), max_dim)
+    angle = determine_skew(gray)
+    if angle is None:
         return None
-    return np.mean(angles)
+    return float(angle)
 
 
-def deskew_and_rotate(image, output_path):
+def deskew_and_rotate(image, angle=None):
     """ "
-    Deskew and rotate the image
-    rtpe: PIL.Image.Image
+    Deskew and rotate the image in memory, estimating the angle if it is not given
+    rtpe: np.ndarray
     """
-    grayscale = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    angle = determine_skew(grayscale)
+    if angle is None:
+        angle = get_skew_angle(image)
+    if angle is None:
+        return image
     rotated = rotate(image, angle, (0, 0, 0))
-    cv2.imwrite(output_path, rotated)
-    output_image = Image.open(output_path)
-    return output_image
+    return rotated
 
 
 def convert_to_1bit(image):
@@ -74,7 +92,7 @@ def convert_to_grayscale(image):
     rtype: PIL.Image.Image
     """
     np_image = np.array(image)
-    grayscale_image = cv2.cvtColor(np_image, cv2.COLOR_BGR2GRAY)
+    grayscale_image = to_grayscale(np_image)
     return grayscale_image
 
 
@@ -99,52 +117,42 @@ def rotate(
     )
 
 
-def get_bounding_boxes(contours, mask, textImg):
+def get_bounding_boxes(contours, mask, textImg, min_size=8):
     """
     Auxiliar function to
-    Get the bounding boxes of the text regions
+    Get the bounding boxes of the text regions.
+    The regions are measured all at once: the contours are filled in a single pass and
+    their box and filled area come from the connected component statistics, so the cost
+    does not depend on the number of contours.
+        Returns:
+            tuple: (min_x, min_y, max_x, max_y) of the text regions.
     """
-    # Initialize min and max coordinates
-    min_x, min_y, max_x, max_y = float("inf"), float("inf"), 0, 0
-    cummTheta = 0
-    ct = 0
-    for idx in range(len(contours)):
-        x, y, w, h = cv2.boundingRect(contours[idx])
-        mask[y : y + h, x : x + w] = 0
-        cv2.drawContours(mask, contours, idx, (255, 255, 255), -1)
-        r = float(cv2.countNonZero(mask[y : y + h, x : x + w])) / (w * h)
-
-        if r > 0.45 and w > 8 and h > 8:
-            rect = cv2.minAreaRect(contours[idx])
-            box = cv2.boxPoints(rect)
-            box = np.int64(box)
-            # cv2.drawContours(textImg, [box], 0, (0, 0, 255), 2)
-
-            theta = slope(box[0][0], box[0][1], box[1][0], box[1][1])
-            cummTheta += theta
-            ct += 1
-
-            # Update min and max coordinates
-            min_x = min(min_x, x)
-            min_y = min(min_y, y)
-            max_x = max(max_x, x + w)
-            max_y = max(max_y, y + h)
-
-    # Check for float("inf") after the loop
-    if min_x == float("inf"):
-        min_x = 0
-    if min_y == float("inf"):
-        min_y = 0
-
-    return int(min_x), int(min_y), int(max_x), int(max_y), cummTheta, ct
-
-
-def slope(x1, y1, x2, y2):
-    if x1 == x2:
-        return 0
-    slope = (y2 - y1) / (x2 - x1)
-    theta = np.rad2deg(np.arctan(slope))
-    return theta
+    if len(contours) == 0:
+        return 0, 0, 0, 0
+
+    # Rellenamos todos los contornos de una vez, cada contorno externo es una componente
+    mask[:] = 0
+    cv2.drawContours(mask, contours, -1, 255, -1)
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+
+    # Componente de cada contorno, tomada en su primer punto
+    first_points = np.array([contour[0, 0] for contour in contours])
+    contour_stats = stats[labels[first_points[:, 1], first_points[:, 0]]]
+    x = contour_stats[:, cv2.CC_STAT_LEFT]
+    y = contour_stats[:, cv2.CC_STAT_TOP]
+    w = contour_stats[:, cv2.CC_STAT_WIDTH]
+    h = contour_stats[:, cv2.CC_STAT_HEIGHT]
+    r = contour_stats[:, cv2.CC_STAT_AREA] / (w * h)
+
+    keep = (r > 0.45) & (w > min_size) & (h > min_size)
+    if not keep.any():
+        return 0, 0, 0, 0
+
+    min_x = x[keep].min()
+    min_y = y[keep].min()
+    max_x = (x[keep] + w[keep]).max()
+    max_y = (y[keep] + h[keep]).max()
+    return int(min_x), int(min_y), int(max_x), int(max_y)
 
 
 def display(img, frameName="OpenCV Image"):
@@ -158,17 +166,22 @@ def display(img, frameName="OpenCV Image"):
     cv2.waitKey(0)
 
 
-def improve_image_quality(input_image_path, output_image_path):
-    filename = os.path.basename(input_image_path)
-    output_image_path = os.path.join(output_image_path, filename)
-    raw_image = cv2.imread(input_image_path)
-
+def improve_image_quality(raw_image):
+    """
+    Crops the image to its text region, deskews it and converts it to grayscale.
+        Args:
+            raw_image (np.ndarray): BGR or grayscale page raster.
+        Returns:
+            np.ndarray|None: Improved grayscale raster, None if there is no image.
+    """
     if raw_image is None:
-        print(f"Image {input_image_path} not found")
+        print("Image not found")
         return None
 
-    # crop image to text region
-    small = cv2.cvtColor(raw_image, cv2.COLOR_BGR2GRAY)
+    # La geometria (recorte e inclinacion) se calcula sobre una copia de tamano acotado
+    # y se aplica a la imagen de resolucion completa
+    gray = to_grayscale(raw_image)
+    small, scale = get_analysis_image(gray)
 
     # find the gradient map
     kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
@@ -178,29 +191,29 @@ def improve_image_quality(input_image_path, output_image_path):
     _, bw = cv2.threshold(grad, 0.0, 255.0, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
 
     # connect horizontally oriented regions
-    # kernal value (9,1) can be changed to improved the text detection
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (9, 1))
+    # kernal value (9,1) can be changed to improved the text detection, scaled to the analysis image
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(3, round(9 * scale)), 1))
     connected = cv2.morphologyEx(bw, cv2.MORPH_CLOSE, kernel)
     contours, hierarchy = cv2.findContours(
         connected.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE
     )  # opencv >= 4.0
     mask = np.zeros(bw.shape, dtype=np.uint8)
-    min_x, min_y, max_x, max_y, cummTheta, ct = get_bounding_boxes(
-        contours, mask, raw_image
+    min_x, min_y, max_x, max_y = get_bounding_boxes(
+        contours, mask, small, min_size=8 * scale
     )
-    cropped = raw_image[min_y:max_y, min_x:max_x]
-    # display(cropped, "Cropped Image")
-
-    skewed_angle = get_skew_angle(cropped)
-    # display(cropped, "Cropped Image")
-    deskewed_image = cropped  # assign a default value
-    if skewed_angle is not None:
-        if abs(skewed_angle) > 0.5:
-            print(f"Image is skewed by {skewed_angle} degrees")
-            deskewed_image = deskew_and_rotate(cropped, output_image_path)
-    else:
-        deskewed_image = cropped
-    # bin_img = convert_to_1bit(deskewed_image)
-    bin_img = convert_to_grayscale(deskewed_image)
+    # crop image to text region, estimating the skew on the analysis crop
+    skewed_angle = get_skew_angle(small[min_y:max_y, min_x:max_x])
+    height, width = gray.shape[:2]
+    min_x, min_y = int(min_x / scale), int(min_y / scale)
+    max_x = min(width, int(math.ceil(max_x / scale)))
+    max_y = min(height, int(math.ceil(max_y / scale)))
+    bin_img = gray[min_y:max_y, min_x:max_x]
+    # display(bin_img, "Cropped Image")
+
+    # Una sola estimacion de la inclinacion, aplicada una sola vez a resolucion completa
+    if skewed_angle is not None and abs(skewed_angle) > SKEW_MIN_ANGLE:
+        print(f"Image is skewed by {skewed_angle} degrees")
+        bin_img = deskew_and_rotate(bin_img, skewed_angle)
+    # bin_img = convert_to_1bit(bin_img)
     # bin_img = (bin_img * 255).astype(np.uint8)
-    cv2.imwrite(output_image_path, bin_img)
+    return bin_img
@@ -1,8 +1,21 @@
 from recognition_worker import recognition_worker
-from fastapi import FastAPI, HTTPException
+from batch_jobs import get_job_queue, submit_batch, start_workers, stop_workers, stream_results
+from executors import run_blocking
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form
+from fastapi.responses import StreamingResponse
+from contextlib import asynccontextmanager
 from models import OCRRequest
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Los workers de lotes viven mientras el servicio este arriba
+    workers = await start_workers()
+    yield
+    await stop_workers(workers)
+
+
+app = FastAPI(lifespan=lifespan)
 
 @app.post("/ocr_recognize")
 async def ocr_recognize(request: OCRRequest):
@@ -12,7 +25,7 @@ async def ocr_recognize(request: OCRRequest):
             A JSON with the relevant information of the file, the extract fields and tokens usage.
     """
     try:
-        data = recognition_worker(
+        data = await recognition_worker(
             request.filename, request.doc_type, request.file_base64
         )
         return {"status": "success", "data": data}
@@ -20,3 +33,55 @@ async def ocr_recognize(request: OCRRequest):
         raise HTTPException(status_code=422, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/batch", status_code=202)
+async def batch_submit(files: list[UploadFile] = File(...), doc_type: str = Form(...)):
+    """
+    Endpoint to queue several documents (PDF, images or zips) of the same type.
+        Returns:
+            A JSON with the batch id and the number of documents queued.
+    """
+    try:
+        uploads = [(file.filename or "", await file.read()) for file in files]
+        data = await submit_batch(uploads, doc_type)
+        return {"status": "success", "data": data}
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/batch/{batch_id}")
+async def batch_status(batch_id: str):
+    """
+    Endpoint to poll the progress of a batch.
+        Returns:
+            A JSON with the count of jobs by status and the status of each job.
+    """
+    data = await run_blocking(get_job_queue().batch_status, batch_id)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Lote no encontrado.")
+    return {"status": "success", "data": data}
+
+
+@app.get("/batch/{batch_id}/jobs/{job_id}")
+async def batch_job(batch_id: str, job_id: str):
+    """
+    Endpoint to get the status and the result of a single job.
+    """
+    data = await run_blocking(get_job_queue().job, batch_id, job_id)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado.")
+    return {"status": "success", "data": data}
+
+
+@app.get("/batch/{batch_id}/results")
+async def batch_results(batch_id: str, follow: bool = False):
+    """
+    Endpoint to download the finished jobs of a batch as NDJSON, one document per line.
+    With follow=true the stream stays open until every job of the batch is finished.
+    """
+    if await run_blocking(get_job_queue().batch_status, batch_id) is None:
+        raise HTTPException(status_code=404, detail="Lote no encontrado.")
+    return StreamingResponse(stream_results(batch_id, follow), media_type="application/x-ndjson")
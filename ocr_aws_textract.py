@@ -1,67 +1,105 @@
 # %% ocr_aws_textract
+from executors import run_blocking
+from clients import get_textract_client, get_s3_client
+from ocr_blocks import OcrBlocks
+from utils.cache_utils import DiskCache, CACHE_FOLDER
 from dotenv import load_dotenv
-import boto3
+import asyncio
+import json
+import time
 import os
 
+"""
+Textract OCR of the pages.
+
+By default every page image is sent to detect_document_text. With
+TEXTRACT_PDF_MODE=document, a PDF with at least TEXTRACT_DOCUMENT_MIN_PAGES pages
+to OCR is uploaded once to S3 (TEXTRACT_S3_BUCKET) and read with the asynchronous
+multi-page API (start_document_text_detection / get_document_text_detection),
+instead of rasterizing, improving and uploading each page. The blocks are
+grouped by page and parsed the same way as a single page.
+
+- TEXTRACT_DOCUMENT_BACKEND: "aws", or "replay" to serve the responses recorded
+  in TEXTRACT_REPLAY_FOLDER without calling AWS (local tests). In "aws" mode the
+  responses are recorded to TEXTRACT_REPLAY_FOLDER when it is set.
+- TEXTRACT_POLL_SECONDS / TEXTRACT_JOB_TIMEOUT: polling interval and maximum wait of a job.
+"""
+
 load_dotenv()
-AWS_ACCESS_KEY_ID = os.environ.get("AWS_ACCESS_KEY_ID")
-AWS_SECRET_ACCESS_KEY = os.environ.get("AWS_SECRET_ACCESS_KEY")
-REGION_NAME = os.environ.get("REGION_NAME")
+# Cache por pagina: el mismo contenido de imagen mejorada devuelve el mismo OCR
+OCR_CACHE_ENABLED = os.environ.get("OCR_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+OCR_CACHE_MAX_MB = int(os.environ.get("OCR_CACHE_MAX_MB", 256))
+# Se incrementa si cambia el calculo del texto, la confianza o el manuscrito
+OCR_CACHE_VERSION = "textract-detect-2"
+ocr_cache = (
+    DiskCache(os.path.join(CACHE_FOLDER, "ocr"), OCR_CACHE_MAX_MB * 1024 * 1024)
+    if OCR_CACHE_ENABLED
+    else None
+)
+OCR_DOCUMENT_CACHE_VERSION = "textract-document-1"
+# Modo de OCR de los PDF: "pages" (una llamada por pagina) o "document" (API asincrona multipagina)
+TEXTRACT_PDF_MODE = os.environ.get("TEXTRACT_PDF_MODE", "pages").lower()
+TEXTRACT_DOCUMENT_MIN_PAGES = int(os.environ.get("TEXTRACT_DOCUMENT_MIN_PAGES", 3))
+TEXTRACT_DOCUMENT_BACKEND = os.environ.get("TEXTRACT_DOCUMENT_BACKEND", "aws").lower()
+TEXTRACT_REPLAY_FOLDER = os.environ.get("TEXTRACT_REPLAY_FOLDER")
+TEXTRACT_S3_BUCKET = os.environ.get("TEXTRACT_S3_BUCKET")
+TEXTRACT_S3_PREFIX = os.environ.get("TEXTRACT_S3_PREFIX", "textract-input/")
+TEXTRACT_POLL_SECONDS = float(os.environ.get("TEXTRACT_POLL_SECONDS", 2))
+TEXTRACT_JOB_TIMEOUT = float(os.environ.get("TEXTRACT_JOB_TIMEOUT", 600))
+# Maximo de bloques por respuesta de get_document_text_detection
+TEXTRACT_MAX_RESULTS = 1000
 
-aws_config = {
-    "aws_access_key_id": AWS_ACCESS_KEY_ID,
-    "aws_secret_access_key": AWS_SECRET_ACCESS_KEY,
-    "region_name": REGION_NAME,
-}
+def bounding_box(block) -> tuple:
+    """
+    Returns the (left, top, width, height) of a Textract block, normalized to the page.
+    """
+    box = block.get("Geometry", {}).get("BoundingBox")
+    if not box:
+        return (0, 0, 0, 0)
+    return (box["Left"], box["Top"], box["Width"], box["Height"])
 
-def extract_text_from_image(image_path: str) -> tuple:
+
+def parse_blocks(blocks) -> tuple:
     """
-    Función para extraer el cuerpo de texto e identificar campos de un formulario.
-        
+    Builds the text corpus of a page from its Textract blocks in a single pass, keeping
+    the LINE and WORD blocks in columnar form for the later stages.
         Args:
-            image_path (str): Ruta de la imagen a procesar.
-
-        Libraries:
-            Install boto3
-            pip install amazon-textract-response-parser
-        
-        Code samples: 
-            https://github.com/aws-samples/amazon-textract-code-samples
+            blocks (list): LINE and WORD blocks of a single page.
+        Returns:
+            tuple: (text_corpus, docConfidence, hasManuscript, ocr_blocks)
     """
-    print("Extracting text from image with AWS...")
     # Definimos variables de control
-    itemsCount = 0
     docConfidence = 0
     wordConfidence = 0
-    wordCount = 0
     hwCount = 0
     hasManuscript = False
-    # Amazon Textract client
-    textract = boto3.client("textract", region_name=aws_config["region_name"],
-    aws_access_key_id=aws_config["aws_access_key_id"],
-    aws_secret_access_key=aws_config["aws_secret_access_key"])
-
-    # Leemos document content
-    with open(image_path, "rb") as document:
-        imageBytes = bytearray(document.read())
-
-    # Llamamos Amazon Textract
-    response = textract.detect_document_text(Document={"Bytes": imageBytes})
-    # Creamos text corpus
-    text_corpus = ""
-    text_corpus_words = ""
-    for item in response["Blocks"]:
-        if item["BlockType"] == "LINE":
-            itemsCount += 1
+    # Columnas de los bloques y textos por tipo, se unen al final
+    block_types, texts, confidences, boxes, handwriting = [], [], [], [], []
+    line_texts, word_texts = [], []
+    for item in blocks:
+        block_type = item["BlockType"]
+        if block_type == "LINE":
             docConfidence += item["Confidence"]
-            text_corpus += item["Text"] + " "
-        if item["BlockType"] == "WORD":
-            wordCount += 1
+            line_texts.append(item["Text"])
+            block_types.append(OcrBlocks.LINE)
+            handwriting.append(False)
+        elif block_type == "WORD":
             wordConfidence += item["Confidence"]
-            text_corpus_words += item["Text"] + " "
-            if item["TextType"] == "HANDWRITING":
-                hwCount += 1
+            word_texts.append(item["Text"])
+            is_handwriting = item.get("TextType") == "HANDWRITING"
+            hwCount += is_handwriting
+            block_types.append(OcrBlocks.WORD)
+            handwriting.append(is_handwriting)
+        else:
+            continue
+        texts.append(item["Text"])
+        confidences.append(item["Confidence"])
+        boxes.append(bounding_box(item))
 
+    itemsCount = len(line_texts)
+    wordCount = len(word_texts)
+    # Creamos text corpus
+    text_corpus = "".join(text + " " for text in line_texts)
     docConfidence = (docConfidence / itemsCount) if itemsCount > 0 else 0
     wordConfidence = (wordConfidence / wordCount) if wordCount > 0 else 0
     print (f"HW COUNT: {hwCount}")
@@ -70,9 +108,190 @@ def extract_text_from_image(image_path: str) -> tuple:
     print (f"HW PERCENTAGE: {hwPercentage}")
     hasManuscript = hwPercentage > 5 and hwPercentage < 20 if hwPercentage > 0 else False
     if wordConfidence > docConfidence:
-        text_corpus = text_corpus_words
+        text_corpus = "".join(text + " " for text in word_texts)
         docConfidence = wordConfidence
     print (f"CONFIDENCE: {docConfidence}")
-    return text_corpus, round(docConfidence,2), hasManuscript
+    docConfidence = round(docConfidence,2)
+    ocr_blocks = OcrBlocks(block_types, texts, confidences, boxes, handwriting)
+    return text_corpus, docConfidence, hasManuscript, ocr_blocks
+
+
+async def extract_text_from_image(image_bytes: bytes) -> tuple:
+    """
+    Función para extraer el cuerpo de texto e identificar campos de un formulario.
+        
+        Args:
+            image_bytes (bytes): Imagen codificada (JPEG o PNG) a procesar.
+
+        Libraries:
+            Install boto3
+            pip install amazon-textract-response-parser
+        
+        Code samples: 
+            https://github.com/aws-samples/amazon-textract-code-samples
+    """
+    # Buscamos el OCR de la pagina en cache por el hash de la imagen
+    if ocr_cache is not None:
+        cache_key = DiskCache.make_key(image_bytes, OCR_CACHE_VERSION)
+        cached_ocr = await run_blocking(ocr_cache.get_json, cache_key)
+        if cached_ocr is not None:
+            print("OCR cache hit")
+            return (
+                cached_ocr["text_corpus"],
+                cached_ocr["docConfidence"],
+                cached_ocr["hasManuscript"],
+                OcrBlocks.from_dict(cached_ocr["ocr_blocks"]),
+            )
+
+    print("Extracting text from image with AWS...")
+    # Amazon Textract client, compartido por todo el proceso
+    textract = get_textract_client()
+
+    # Llamamos Amazon Textract (boto3 es bloqueante, se ejecuta fuera del event loop)
+    response = await run_blocking(
+        textract.detect_document_text, Document={"Bytes": image_bytes}
+    )
+    text_corpus, docConfidence, hasManuscript, ocr_blocks = parse_blocks(response["Blocks"])
+    if ocr_cache is not None:
+        await run_blocking(
+            ocr_cache.set_json,
+            cache_key,
+            {
+                "text_corpus": text_corpus,
+                "docConfidence": docConfidence,
+                "hasManuscript": hasManuscript,
+                "ocr_blocks": ocr_blocks.to_dict(),
+            },
+        )
+    return text_corpus, docConfidence, hasManuscript, ocr_blocks
+
+
+def use_document_mode(ocr_page_count) -> bool:
+    """
+    Checks if the pages of a PDF that need OCR should be read with a single document job.
+    """
+    if TEXTRACT_PDF_MODE != "document" or ocr_page_count < TEXTRACT_DOCUMENT_MIN_PAGES:
+        return False
+    if TEXTRACT_DOCUMENT_BACKEND == "replay":
+        return bool(TEXTRACT_REPLAY_FOLDER)
+    return bool(TEXTRACT_S3_BUCKET)
+
+
+class ReplayTextractClient:
+    """
+    Local stand-in of the Textract asynchronous API. Serves the responses recorded in a
+    folder as '<document key>.json' ({"Blocks": [...]}), paginated like Textract.
+        Args:
+            folder: Folder with the recorded responses.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def start_document_text_detection(self, DocumentLocation, **kwargs) -> dict:
+        name = DocumentLocation["S3Object"]["Name"]
+        return {"JobId": os.path.splitext(os.path.basename(name))[0]}
+
+    def get_document_text_detection(self, JobId, MaxResults=TEXTRACT_MAX_RESULTS, NextToken=None) -> dict:
+        file_path = os.path.join(self.folder, JobId + ".json")
+        if not os.path.exists(file_path):
+            return {"JobStatus": "FAILED", "StatusMessage": f"No recording for {JobId}"}
+        with open(file_path, encoding="utf-8") as file:
+            blocks = json.load(file)["Blocks"]
+        start = int(NextToken or 0)
+        response = {"JobStatus": "SUCCEEDED", "Blocks": blocks[start:start + MaxResults]}
+        if start + MaxResults < len(blocks):
+            response["NextToken"] = str(start + MaxResults)
+        return response
+
+
+def record_blocks(document_key, blocks) -> None:
+    """
+    Saves the blocks of a document job so ReplayTextractClient can serve them later.
+    """
+    os.makedirs(TEXTRACT_REPLAY_FOLDER, exist_ok=True)
+    with open(os.path.join(TEXTRACT_REPLAY_FOLDER, document_key + ".json"), "w", encoding="utf-8") as file:
+        json.dump({"Blocks": blocks}, file)
+
+
+async def get_document_blocks(textract, job_id) -> list:
+    """
+    Waits for a document text detection job and returns all its blocks, following the pagination.
+    """
+    deadline = time.monotonic() + TEXTRACT_JOB_TIMEOUT
+    blocks = []
+    next_token = None
+    while True:
+        kwargs = {"JobId": job_id, "MaxResults": TEXTRACT_MAX_RESULTS}
+        if next_token:
+            kwargs["NextToken"] = next_token
+        response = await run_blocking(textract.get_document_text_detection, **kwargs)
+        status = response["JobStatus"]
+        if status == "IN_PROGRESS":
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Textract job {job_id} did not finish in {TEXTRACT_JOB_TIMEOUT} seconds")
+            await asyncio.sleep(TEXTRACT_POLL_SECONDS)
+            continue
+        if status == "FAILED":
+            raise RuntimeError(f"Textract job {job_id} failed: {response.get('StatusMessage')}")
+        if status == "PARTIAL_SUCCESS":
+            print(f"Textract job {job_id} partially succeeded: {response.get('Warnings')}")
+        blocks += response.get("Blocks", [])
+        next_token = response.get("NextToken")
+        if not next_token:
+            return blocks
+
+
+async def extract_text_from_pdf(file_bytes: bytes, page_count: int) -> list:
+    """
+    Extracts the text of every page of a PDF with a single Textract document job.
+        Args:
+            file_bytes (bytes): Content of the PDF file.
+            page_count (int): Number of pages of the PDF.
+        Returns:
+            list: One (text_corpus, docConfidence, hasManuscript) tuple per page, in order.
+    """
+    document_key = DiskCache.make_key(file_bytes, OCR_DOCUMENT_CACHE_VERSION)
+    if ocr_cache is not None:
+        cached_ocr = await run_blocking(ocr_cache.get_json, document_key)
+        if cached_ocr is not None:
+            print("OCR cache hit")
+            return [tuple(page) for page in cached_ocr["pages"]]
+
+    print(f"Extracting text from a {page_count} page PDF with an AWS document job...")
+    s3_object = {"Bucket": TEXTRACT_S3_BUCKET, "Name": TEXTRACT_S3_PREFIX + document_key + ".pdf"}
+    if TEXTRACT_DOCUMENT_BACKEND == "replay":
+        textract = ReplayTextractClient(TEXTRACT_REPLAY_FOLDER)
+        s3 = None
+    else:
+        textract = get_textract_client()
+        s3 = get_s3_client()
+        # Subimos el PDF una sola vez, Textract lee el documento completo desde S3
+        await run_blocking(
+            s3.put_object, Bucket=s3_object["Bucket"], Key=s3_object["Name"], Body=file_bytes
+        )
+    try:
+        job = await run_blocking(
+            textract.start_document_text_detection, DocumentLocation={"S3Object": s3_object}
+        )
+        blocks = await get_document_blocks(textract, job["JobId"])
+    finally:
+        if s3 is not None:
+            await run_blocking(s3.delete_object, Bucket=s3_object["Bucket"], Key=s3_object["Name"])
+    if s3 is not None and TEXTRACT_REPLAY_FOLDER:
+        await run_blocking(record_blocks, document_key, blocks)
+
+    # Agrupamos los bloques por pagina (Page empieza en 1)
+    blocks_by_page = [[] for _ in range(page_count)]
+    for block in blocks:
+        page = block.get("Page", 1) - 1
+        if 0 <= page < page_count:
+            blocks_by_page[page].append(block)
+    # La geometria es relativa a la pagina del PDF, no a la imagen mejorada, solo se conserva el texto
+    pages = [parse_blocks(page_blocks)[:3] for page_blocks in blocks_by_page]
+
+    if ocr_cache is not None:
+        await run_blocking(ocr_cache.set_json, document_key, {"pages": pages})
+    return pages
 
 # %%
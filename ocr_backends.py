@@ -0,0 +1,218 @@
+# %% OCR backends
+
+from ocr_aws_textract import extract_text_from_image, parse_blocks
+from executors import run_cpu_bound
+from page_image import PageImage
+from dotenv import load_dotenv
+from abc import ABC, abstractmethod
+import os
+
+try:
+    import pytesseract
+except ImportError:
+    pytesseract = None
+
+"""
+OCR engines behind a common interface. Every backend returns the same
+(text_corpus, docConfidence, hasManuscript, ocr_blocks) tuple for a page, so
+the rest of the pipeline does not know which engine read it.
+
+INSTALLATION (only for the local engine):
+pip install pytesseract
+apt install tesseract-ocr tesseract-ocr-spa
+
+- OCR_BACKEND: "textract" (default), "tesseract", or "local_first" to read the
+  page with Tesseract and escalate to Textract only when its confidence is below
+  OCR_LOCAL_MIN_CONFIDENCE. If Textract fails (e.g. throttling) the local result
+  is kept, so the service keeps working.
+- TESSERACT_LANG / TESSERACT_CONFIG: language and options of Tesseract.
+- TESSERACT_CONFIDENCE_OFFSET: added to the Tesseract confidence to calibrate it
+  against Textract, since the thresholds of the pipeline were tuned with Textract.
+
+The Tesseract words are converted to Textract-like LINE and WORD blocks and
+aggregated with the same parse_blocks, so the confidence is computed the same
+way. Tesseract does not tell handwriting apart: its words are PRINTED, and
+handwritten pages usually fall below the threshold and escalate to Textract.
+"""
+
+load_dotenv()
+OCR_BACKEND = os.environ.get("OCR_BACKEND", "textract").lower()
+OCR_LOCAL_MIN_CONFIDENCE = float(os.environ.get("OCR_LOCAL_MIN_CONFIDENCE", 90))
+TESSERACT_LANG = os.environ.get("TESSERACT_LANG", "spa")
+TESSERACT_CONFIG = os.environ.get("TESSERACT_CONFIG", "--oem 1 --psm 3")
+TESSERACT_CONFIDENCE_OFFSET = float(os.environ.get("TESSERACT_CONFIDENCE_OFFSET", 0))
+
+
+class OcrBackend(ABC):
+    """
+    Base class of the OCR engines.
+    """
+
+    name = None
+
+    def is_available(self) -> bool:
+        return True
+
+    @abstractmethod
+    async def extract(self, image: PageImage) -> tuple:
+        """
+        Extracts the text of a page.
+            Returns:
+                tuple: (text_corpus, docConfidence, hasManuscript, ocr_blocks)
+        """
+
+
+class TextractBackend(OcrBackend):
+    """
+    AWS Textract detect_document_text, with the page encoded within the Textract budget.
+    """
+
+    name = "textract"
+
+    async def extract(self, image: PageImage) -> tuple:
+        encoded = await run_cpu_bound(image.encode_for, "textract")
+        return await extract_text_from_image(encoded.data)
+
+
+def tesseract_blocks(data) -> list:
+    """
+    Converts the output of pytesseract.image_to_data into Textract-like LINE and WORD blocks,
+    with confidences from 0 to 100 and the geometry normalized to the page size.
+    """
+    page_width = max(data["width"][0], 1) if data["level"] else 1
+    page_height = max(data["height"][0], 1) if data["level"] else 1
+
+    def geometry(left, top, width, height):
+        return {
+            "BoundingBox": {
+                "Left": left / page_width,
+                "Top": top / page_height,
+                "Width": width / page_width,
+                "Height": height / page_height,
+            }
+        }
+
+    lines = {}
+    for index, text in enumerate(data["text"]):
+        confidence = float(data["conf"][index])
+        text = text.strip()
+        # Tesseract marca con -1 los elementos que no son palabras
+        if not text or confidence < 0:
+            continue
+        confidence = min(max(confidence + TESSERACT_CONFIDENCE_OFFSET, 0), 100)
+        left, top = data["left"][index], data["top"][index]
+        width, height = data["width"][index], data["height"][index]
+        word = {
+            "BlockType": "WORD",
+            "Text": text,
+            "Confidence": confidence,
+            "TextType": "PRINTED",
+            "Geometry": geometry(left, top, width, height),
+        }
+        key = (data["block_num"][index], data["par_num"][index], data["line_num"][index])
+        lines.setdefault(key, []).append((word, (left, top, left + width, top + height)))
+
+    blocks = []
+    for words in lines.values():
+        boxes = [box for _, box in words]
+        left, top = min(box[0] for box in boxes), min(box[1] for box in boxes)
+        right, bottom = max(box[2] for box in boxes), max(box[3] for box in boxes)
+        blocks.append({
+            "BlockType": "LINE",
+            "Text": " ".join(word["Text"] for word, _ in words),
+            "Confidence": sum(word["Confidence"] for word, _ in words) / len(words),
+            "Geometry": geometry(left, top, right - left, bottom - top),
+        })
+        blocks += [word for word, _ in words]
+    return blocks
+
+
+class TesseractBackend(OcrBackend):
+    """
+    Local Tesseract OCR, without network calls. Needs pytesseract and the tesseract binary.
+    """
+
+    name = "tesseract"
+
+    def __init__(self):
+        self._available = None
+
+    def is_available(self) -> bool:
+        """
+        Checks once if pytesseract and the tesseract binary are installed.
+        """
+        if self._available is None:
+            try:
+                self._available = pytesseract is not None and bool(pytesseract.get_tesseract_version())
+            except Exception as e:
+                print(f"Tesseract is not installed. Reason: {e}")
+                self._available = False
+        return self._available
+
+    def _read(self, array) -> tuple:
+        data = pytesseract.image_to_data(
+            array,
+            lang=TESSERACT_LANG,
+            config=TESSERACT_CONFIG,
+            output_type=pytesseract.Output.DICT,
+        )
+        return parse_blocks(tesseract_blocks(data))
+
+    async def extract(self, image: PageImage) -> tuple:
+        print("Extracting text from image with Tesseract...")
+        return await run_cpu_bound(self._read, image.array)
+
+
+BACKENDS = {backend.name: backend for backend in (TextractBackend(), TesseractBackend())}
+
+
+def get_ocr_backend(name) -> OcrBackend:
+    """
+    Returns the OCR backend registered under name. Raises RuntimeError if the name is
+    unknown or the engine is not installed, since it is a configuration error of the
+    service and not a problem of the document.
+    """
+    if name not in BACKENDS:
+        raise RuntimeError(f"OCR_BACKEND no reconocido: {name}. Usa textract, tesseract o local_first.")
+    backend = BACKENDS[name]
+    if not backend.is_available():
+        raise RuntimeError(
+            f"El motor de OCR {name} no esta instalado. Instala pytesseract y tesseract-ocr o cambia OCR_BACKEND."
+        )
+    return backend
+
+
+async def extract_page_text(image: PageImage, policy=OCR_BACKEND) -> tuple:
+    """
+    Extracts the text of an improved page with the OCR policy.
+        Args:
+            image (PageImage): Improved page.
+            policy (str): "textract", "tesseract" or "local_first".
+        Returns:
+            tuple: (text_corpus, docConfidence, hasManuscript, ocr_blocks)
+    """
+    if policy != "local_first":
+        return await get_ocr_backend(policy).extract(image)
+
+    local_backend = BACKENDS["tesseract"]
+    local_result = None
+    if local_backend.is_available():
+        try:
+            local_result = await local_backend.extract(image)
+        except Exception as e:
+            print(f"Tesseract failed on {image.name}. Reason: {e}")
+    else:
+        print("Tesseract is not available, using Textract")
+
+    if local_result is not None and local_result[1] >= OCR_LOCAL_MIN_CONFIDENCE:
+        print(f"Local OCR confidence {local_result[1]} on {image.name}, Textract skipped")
+        return local_result
+
+    try:
+        return await BACKENDS["textract"].extract(image)
+    except Exception as e:
+        if local_result is None:
+            raise
+        # Si Textract no responde conservamos el resultado local
+        print(f"Textract failed on {image.name}, keeping the local OCR. Reason: {e}")
+        return local_result
@@ -0,0 +1,82 @@
+import numpy as np
+
+"""
+Columnar OCR blocks of a page.
+
+The LINE and WORD blocks of an OCR response are kept as parallel columns
+(block type, text, confidence, bounding box and handwriting flag) instead of
+one dict per block, so later stages can filter them with numpy masks, e.g. to
+crop the low-confidence or handwritten regions of the page.
+
+The boxes are (left, top, width, height) normalized to the size of the image
+that was read, the same convention as the Textract BoundingBox, so they can be
+mapped to any resolution of that image.
+"""
+
+
+class OcrBlocks:
+    """
+    LINE and WORD blocks of a page in columnar form.
+        Args:
+            block_types: OcrBlocks.LINE or OcrBlocks.WORD per block.
+            texts: Text of each block.
+            confidences: Confidence of each block (0-100).
+            boxes: (left, top, width, height) of each block, normalized to the page.
+            handwriting: True for the handwritten words.
+    """
+
+    __slots__ = ("block_types", "texts", "confidences", "boxes", "handwriting")
+
+    LINE = 0
+    WORD = 1
+
+    def __init__(self, block_types=(), texts=(), confidences=(), boxes=(), handwriting=()):
+        self.block_types = np.asarray(block_types, dtype=np.uint8)
+        self.texts = list(texts)
+        self.confidences = np.asarray(confidences, dtype=np.float32)
+        self.boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.handwriting = np.asarray(handwriting, dtype=bool)
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def select(self, mask) -> "OcrBlocks":
+        """
+        Returns the blocks where the boolean mask is True.
+        """
+        mask = np.asarray(mask, dtype=bool)
+        return OcrBlocks(
+            self.block_types[mask],
+            [text for text, keep in zip(self.texts, mask) if keep],
+            self.confidences[mask],
+            self.boxes[mask],
+            self.handwriting[mask],
+        )
+
+    def lines(self) -> "OcrBlocks":
+        return self.select(self.block_types == OcrBlocks.LINE)
+
+    def words(self) -> "OcrBlocks":
+        return self.select(self.block_types == OcrBlocks.WORD)
+
+    def to_dict(self) -> dict:
+        """
+        Serializes the blocks to plain lists, e.g. to store them in the OCR cache.
+        """
+        return {
+            "block_types": self.block_types.tolist(),
+            "texts": self.texts,
+            "confidences": self.confidences.tolist(),
+            "boxes": self.boxes.tolist(),
+            "handwriting": self.handwriting.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, data) -> "OcrBlocks":
+        return cls(
+            data["block_types"],
+            data["texts"],
+            data["confidences"],
+            data["boxes"],
+            data["handwriting"],
+        )
@@ -0,0 +1,205 @@
+from typing import NamedTuple
+from dotenv import load_dotenv
+import numpy as np
+import cv2
+import os
+
+"""
+In-memory page images passed between the pipeline stages.
+
+A page travels as a numpy array from rasterization to OCR and vision, and is
+encoded only when a backend needs the bytes. Each encoding is cached, so
+Textract and Gemini share the same bytes instead of re-encoding the page.
+
+Each backend has an encoding profile: the page is encoded with the best quality
+and resolution that fits the byte budget of the backend, without going below
+the minimum dimension that keeps the text legible.
+- TEXTRACT_MAX_BYTES / TEXTRACT_MAX_DIM: Textract rejects images above 5 MB.
+- VISION_MAX_BYTES / VISION_MAX_DIM: Gemini bills images by 768 px tiles, so a
+  bounded size keeps the input tokens of the page bounded too.
+"""
+
+load_dotenv()
+MIME_TYPES = {"jpeg": "image/jpeg", "jpg": "image/jpeg", "png": "image/png"}
+# Perfiles de codificacion por servicio
+ENCODING_PROFILES = {
+    "textract": {
+        "max_bytes": int(os.environ.get("TEXTRACT_MAX_BYTES", 5 * 1024 * 1024)),
+        "max_dim": int(os.environ.get("TEXTRACT_MAX_DIM", 4000)),
+        "min_dim": 1000,
+        "qualities": (95, 90, 80, 70),
+    },
+    "vision": {
+        "max_bytes": int(os.environ.get("VISION_MAX_BYTES", 1024 * 1024)),
+        "max_dim": int(os.environ.get("VISION_MAX_DIM", 1536)),
+        "min_dim": 768,
+        "qualities": (90, 80, 70),
+    },
+}
+# Reduccion de la imagen en cada intento cuando ninguna calidad cabe en el presupuesto
+ENCODING_SCALE_STEP = 0.8
+
+
+class EncodedImage(NamedTuple):
+    data: bytes
+    mime_type: str
+    # Parametros elegidos por el codificador (formato, calidad, dimensiones y bytes)
+    params: dict = None
+
+
+def resize_to_max_dim(array, max_dim) -> np.ndarray:
+    """
+    Downscales the raster so its largest side is at most max_dim
+    """
+    scale = max_dim / max(array.shape[:2])
+    if scale >= 1:
+        return array
+    return cv2.resize(array, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+
+def encode_to_budget(array, profile, image_format="jpeg") -> EncodedImage:
+    """
+    Encodes a raster with the highest quality and resolution that fits the byte budget
+    of the profile. PNG pages are kept lossless when they fit, otherwise JPEG qualities
+    are tried from best to worst, and then the page is downscaled step by step down to
+    the minimum dimension. If nothing fits, the smallest attempt is returned.
+        Args:
+            array: Page raster as a numpy array.
+            profile: One of ENCODING_PROFILES.
+            image_format: Format of the page, png pages try a lossless encoding first.
+        Returns:
+            EncodedImage: The encoded page with the chosen parameters.
+    """
+    image = resize_to_max_dim(array, profile["max_dim"])
+    attempt = None
+    while True:
+        candidates = [("png", None)] if image_format == "png" else []
+        candidates += [("jpeg", quality) for quality in profile["qualities"]]
+        for candidate_format, quality in candidates:
+            if candidate_format == "png":
+                ok, buffer = cv2.imencode(".png", image, [cv2.IMWRITE_PNG_COMPRESSION, 3])
+            else:
+                ok, buffer = cv2.imencode(".jpeg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if not ok:
+                continue
+            height, width = image.shape[:2]
+            attempt = EncodedImage(
+                buffer.tobytes(),
+                MIME_TYPES[candidate_format],
+                {
+                    "format": candidate_format,
+                    "quality": quality,
+                    "width": width,
+                    "height": height,
+                    "bytes": len(buffer),
+                },
+            )
+            if len(buffer) <= profile["max_bytes"]:
+                return attempt
+        max_dim = int(max(image.shape[:2]) * ENCODING_SCALE_STEP)
+        if max_dim < profile["min_dim"]:
+            break
+        image = resize_to_max_dim(image, max_dim)
+    if attempt is None:
+        raise ValueError("No fue posible codificar la imagen.")
+    print(f"Image does not fit in {profile['max_bytes']} bytes, sending {attempt.params}")
+    return attempt
+
+
+class PageImage:
+    """
+    A page raster and the format it is encoded to when sent to a backend.
+        Args:
+            name: File name of the page, used in logs, the response and debug files.
+            array: Page raster as a numpy array (BGR or grayscale).
+            image_format: Output format of the page (jpeg or png).
+    """
+
+    def __init__(self, name: str, array: np.ndarray, image_format: str = "jpeg"):
+        self.name = name
+        self.array = array
+        self.image_format = "jpeg" if image_format == "jpg" else image_format
+        # Bloques del OCR de la pagina (OcrBlocks), None si no paso por OCR
+        self.ocr_blocks = None
+        self._encoded = {}
+        self._encoded_for = {}
+        # Parametros de las codificaciones liberadas con release()
+        self._released_params = {}
+
+    def encode(self, image_format=None) -> EncodedImage:
+        """
+        Encodes the page once per format and returns the cached bytes.
+        """
+        image_format = image_format or self.image_format
+        if image_format not in self._encoded:
+            ok, buffer = cv2.imencode("." + image_format, self.array)
+            if not ok:
+                raise ValueError(f"No fue posible codificar la imagen {self.name}.")
+            self._encoded[image_format] = EncodedImage(
+                buffer.tobytes(), MIME_TYPES.get(image_format, "image/jpeg")
+            )
+        return self._encoded[image_format]
+
+    def encode_for(self, backend) -> EncodedImage:
+        """
+        Encodes the page once per backend ("textract" or "vision") to fit its profile
+        and returns the cached bytes.
+        """
+        if backend not in self._encoded_for:
+            self._encoded_for[backend] = encode_to_budget(
+                self.array, ENCODING_PROFILES[backend], self.image_format
+            )
+        return self._encoded_for[backend]
+
+    def encodings(self) -> dict:
+        """
+        Returns the encoding parameters chosen for each backend the page was sent to.
+        """
+        params = dict(self._released_params)
+        params.update({backend: encoded.params for backend, encoded in self._encoded_for.items()})
+        return params
+
+    def release(self):
+        """
+        Drops the raster and the encoded bytes once no backend needs them, keeping the
+        encoding parameters for the response and the OCR blocks.
+        """
+        self._released_params = self.encodings()
+        self.array = None
+        self._encoded = {}
+        self._encoded_for = {}
+
+    async def load(self) -> "PageImage":
+        """
+        Returns the page itself, so it can be used wherever a LazyPageImage is expected.
+        """
+        return self
+
+
+class LazyPageImage:
+    """
+    A page whose raster is produced only when a backend asks for it, e.g. a PDF page
+    whose text layer was used instead of OCR and that is later sent to vision.
+        Args:
+            name: File name of the page.
+            loader: Coroutine function that returns the PageImage of the page.
+    """
+
+    def __init__(self, name: str, loader):
+        self.name = name
+        self._loader = loader
+        self._image = None
+
+    async def load(self) -> PageImage:
+        """
+        Produces the page on first use and returns the same PageImage afterwards.
+        """
+        if self._image is None:
+            self._image = await self._loader()
+        return self._image
+
+    def encodings(self) -> dict:
+        """
+        Returns the encoding parameters of the page, empty if it was never produced.
+        """
+        return self._image.encodings() if self._image is not None else {}
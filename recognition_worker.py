@@ -1,32 +1,99 @@
-from utils.file_utils import FileUtils
 from utils.general_utils import Utils
 from vision_recognition import vision_entity_extraction
+from vision_regions import vision_region_extraction, uses_regions, add_usage
 from chat_completion import chat_completions_entity_extraction
+from rule_extractor import extract_fields, is_complete, merge_fields
 from base64 import b64decode
 from document_handler import document_handler
+from workspace import Workspace, IMAGE_RAW, TEXT_EXTRACTED
+from executors import map_pages, run_blocking
+from utils.cache_utils import DiskCache, CACHE_FOLDER
+from fastapi.encoders import jsonable_encoder
+from dotenv import load_dotenv
 import os
 import re
 import sys
+import json
 import thresholds
+import example_store
+import subtype_classifier
+import image_pre_procesing
+import improve_image_quality
+import ocr_aws_textract
+import ocr_backends
+import page_image
+import rule_extractor
+import vision_regions
 
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-image_raw_folder = os.path.join(os.getcwd(), "0_image_raw")
-image_preprocessed_folder = os.path.join(os.getcwd(), "1_image_preprocessed")
-text_extracted_folder = os.path.join(os.getcwd(), "3_text_extracted")
-
 image_inject_folder = os.path.join(os.getcwd(), "image_inject")
 data_inject_folder = os.path.join(os.getcwd(), "data_inject")
 thresholds.length_threshold_calculator(data_inject_folder)
+example_store.preload(image_inject_folder, data_inject_folder)
+subtype_classifier.preload(data_inject_folder)
+
+load_dotenv()
+# Version del pipeline, se incrementa cuando un cambio altera los resultados para invalidar la cache
+PIPELINE_VERSION = "5"
+# Configuracion que altera los resultados, forma parte de la llave de la cache junto con la version
+RESULT_SETTINGS = json.dumps(
+    {
+        "ocr_backend": ocr_backends.OCR_BACKEND,
+        "ocr_local_min_confidence": ocr_backends.OCR_LOCAL_MIN_CONFIDENCE,
+        "tesseract": [
+            ocr_backends.TESSERACT_LANG,
+            ocr_backends.TESSERACT_CONFIG,
+            ocr_backends.TESSERACT_CONFIDENCE_OFFSET,
+        ],
+        "textract_pdf_mode": [ocr_aws_textract.TEXTRACT_PDF_MODE, ocr_aws_textract.TEXTRACT_DOCUMENT_MIN_PAGES],
+        "pdf_dpi": image_pre_procesing.PDF_DPI_BY_DOCTYPE,
+        "pdf_grayscale": image_pre_procesing.PDF_GRAYSCALE,
+        "pdf_text": [image_pre_procesing.PDF_TEXT_MIN_CHARS, image_pre_procesing.PDF_TEXT_CLEAN_RATIO],
+        "analysis": [
+            improve_image_quality.ANALYSIS_MAX_DIM,
+            improve_image_quality.SKEW_MAX_DIM,
+            improve_image_quality.SKEW_MIN_ANGLE,
+        ],
+        "encoding_profiles": page_image.ENCODING_PROFILES,
+        "vision_roi": [
+            vision_regions.VISION_ROI_ENABLED,
+            vision_regions.VISION_ROI_DOCTYPES,
+            vision_regions.ROI_MIN_CONFIDENCE,
+            vision_regions.ROI_PADDING_X,
+            vision_regions.ROI_PADDING_Y,
+            vision_regions.ROI_MAX_REGIONS,
+            vision_regions.ROI_MAX_AREA,
+        ],
+        "vision_examples_k": example_store.VISION_EXAMPLES_K,
+        "vision_token_budget": example_store.VISION_TOKEN_BUDGET,
+        "subtype": [subtype_classifier.SUBTYPE_MIN_SCORE, subtype_classifier.SUBTYPE_MIN_MARGIN],
+        "rules_min_confidence": rule_extractor.RULES_MIN_CONFIDENCE,
+        "models": [example_store.CHAT_MODEL, example_store.VISION_MODEL],
+    },
+    sort_keys=True,
+)
+RESULT_CACHE_ENABLED = os.environ.get("RESULT_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+RESULT_CACHE_MAX_MB = int(os.environ.get("RESULT_CACHE_MAX_MB", 512))
+RESULT_CACHE_TTL_HOURS = float(os.environ.get("RESULT_CACHE_TTL_HOURS", 24 * 7))
+result_cache = (
+    DiskCache(
+        os.path.join(CACHE_FOLDER, "results"),
+        RESULT_CACHE_MAX_MB * 1024 * 1024,
+        RESULT_CACHE_TTL_HOURS * 3600,
+    )
+    if RESULT_CACHE_ENABLED
+    else None
+)
 
 # TODO: Add logic for two paged documents
 
 
-def recognition_worker(filename=str, doctype=str, file_base64=str) -> dict:
+async def recognition_worker(filename=str, doctype=str, file_base64=str) -> dict:
     """
     Main function to process the document and extract the information from it.
         Args:
-            file_path: Path to the document to process.
+            filename: Name of the document to process.
             doctype: Type of document to process. It can be one of the following: IMSS, INFONAVIT, SAT.
             file_base64: The content of the file in base64.
         Returns:
@@ -38,113 +105,201 @@ def recognition_worker(filename=str, doctype=str, file_base64=str) -> dict:
     )
     if data_url_pattern.match(file_base64):
         file_base64 = data_url_pattern.sub("", file_base64)
-    # Borramos todas los archivos de la carpeta 0 y 3
-    FileUtils.delete_from_folder(image_raw_folder)
-    # FileUtils.delete_from_folder(text_extracted_folder)
+    # Decodeamos el contenido del documento, se procesa en memoria
+    file_bytes = b64decode(file_base64)
+    return await recognize_document(file_bytes, filename, doctype)
+
+
+async def recognize_document(file_bytes=bytes, filename=str, doctype=str) -> dict:
+    """
+    Extracts the information from the decoded document, answering from the result cache when
+    the same document was already processed.
+        Args:
+            file_bytes: The content of the document.
+            filename: Name of the document to process.
+            doctype: Type of document to process. It can be one of the following: IMSS, INFONAVIT, SAT.
+        Returns:
+            dict: A dictionary with the extracted information from the document.
+    """
+    # Un documento ya procesado se responde desde la cache sin llamar servicios externos
+    if result_cache is not None:
+        cache_key = DiskCache.make_key(file_bytes, doctype, PIPELINE_VERSION, RESULT_SETTINGS)
+        cached_extraction = await run_blocking(result_cache.get_json, cache_key)
+        if cached_extraction is not None:
+            print(f"Result cache hit for {filename}")
+            cached_extraction["filename"] = os.path.basename(filename)
+            # No se consumieron tokens, el uso original no se reporta de nuevo
+            cached_extraction["cached"] = True
+            if "usage" in cached_extraction:
+                cached_extraction["usage"] = None
+            for page in cached_extraction.get("pages", {}).values():
+                if isinstance(page, dict) and "usage" in page:
+                    page["usage"] = None
+            return cached_extraction
+
+    extraction = await document_extraction(file_bytes, filename, doctype)
+    extraction["cached"] = False
+
+    if result_cache is not None:
+        await run_blocking(result_cache.set_json, cache_key, jsonable_encoder(extraction))
+    return extraction
+
+
+async def document_extraction(file_bytes=bytes, filename=str, doctype=str) -> dict:
+    """
+    Processes the decoded document and extracts the information from it.
+        Args:
+            file_bytes: The content of the document.
+            filename: Name of the document to process.
+            doctype: Type of document to process. It can be one of the following: IMSS, INFONAVIT, SAT.
+        Returns:
+            dict: A dictionary with the extracted information from the document.
+    """
+    # Cada solicitud tiene su propio workspace, solo escribe a disco en modo debug
+    with Workspace() as workspace:
+        # En modo debug guardamos el contenido del documento en la carpeta 0
+        workspace.save(IMAGE_RAW, filename, file_bytes)
+
+        # Mandamos al manejador de documentos para mejorar la calidad y generar la extraccion de datos
+        def needs_image(text_corpus, docConfidence, hasManuscript) -> bool:
+            # Solo las paginas que van a vision conservan la imagen despues del OCR
+            _, _, process_type = raw_text_validator(text_corpus, doctype, docConfidence, hasManuscript)
+            return process_type == "vision_entity_extraction"
+
+        text_extracted, docConfidence, hasManuscript, improved_image = await document_handler(
+            file_bytes, filename, doctype, workspace, needs_image
+        )
+        # return (text_extracted, docConfidence, hasManuscript)
+        # En modo debug guardamos el texto extraido en la carpeta 3
+        workspace.save(TEXT_EXTRACTED, re.sub(r"\.(pdf|jpg|jpeg)$", ".txt", filename, flags=re.IGNORECASE), str(text_extracted))
     
-    # Decodeamos el contenido del documento
-    image = b64decode(file_base64)
-    # Guardamos el contenido del documento en la carpeta 0 para procesar la calidad del documento
-    file_path = FileUtils.save(image_raw_folder + "/" + filename, image)
-
-    # Mandamos al manejador de documentos para mejorar la calidad y generar la extraccion de datos
-    text_extracted, docConfidence, hasManuscript, improved_image_path = document_handler(file_path, doctype)
-    # return (text_extracted, docConfidence, hasManuscript)
-    # TODO: Comentar esta linea
-    # Guardamos el texto extraido en la carpeta 3
-    FileUtils.save(text_extracted_folder + "/" + re.sub(r"\.(pdf|jpg|jpeg)$", ".txt", filename, flags=re.IGNORECASE), str(text_extracted))
+        # Si el documento contiene multi-pagina
+        if isinstance(text_extracted, list):
+            # Contruimos JSON dictionary
+            extraction = {
+                "filename": os.path.basename(filename),
+                "doc_type": doctype,
+                "num_pages": len(text_extracted),
+                "pages": {}
+            }
+            # Extraemos las paginas en paralelo, conservando su orden
+            pages = await map_pages(
+                lambda items: page_extraction(items, doctype), text_extracted
+            )
+            for itemCount, page in enumerate(pages):
+                extraction["pages"][itemCount] = page
+            return extraction
+            
+        # Validar la calidad del texto extraído
+        text_quality, message, process_type = raw_text_validator(text_extracted, doctype, docConfidence, hasManuscript)
+        print (text_quality,message,process_type)
+    
+        # Si el texto es inválido, lanzar error
+        if not text_quality:
+            raise ValueError(message)
     
-    # Si el documento contiene multi-pagina
-    if isinstance(text_extracted, list):
-        errorMsg = None
-        itemCount = 0
+        # Procesar con la función correspondiente
+        if process_type not in ("vision_entity_extraction", "chat_completions_entity_extraction"):
+            raise ValueError("Método de procesamiento no valido.")
+        process_type, fields_extracted, usage, content = await entity_extraction(
+            text_extracted, docConfidence, process_type, improved_image, doctype
+        )
+
         # Contruimos JSON dictionary
         extraction = {
-            "filename": os.path.basename(file_path),
+            "filename": os.path.basename(filename),
             "doc_type": doctype,
-            "num_pages": len(text_extracted),
-            "pages": {}
+            "process_type": process_type,
+            "values": fields_extracted,
+            "usage": usage,
+            "content": str(content),
+            "encoding": improved_image.encodings(),
         }
-        for items in text_extracted:
-            # Validar la calidad del texto extraído
-            text_quality, message, process_type = raw_text_validator(items[0], doctype, items[1], items[2])
-            print (text_quality,message,process_type)
-            
-            # Si el texto es inválido, anexar error
-            if not text_quality:
-                errorMsg = message
-            
-            if errorMsg == None:
-                # Procesar con la función correspondiente
-                if process_type == "vision_entity_extraction":
-                    # fields_extracted, usage = ("hola", 2000)
-                    fields_extracted, usage, content = vision_entity_extraction(
-                        items[3], image_inject_folder, doctype
-                    )
-                elif process_type == "chat_completions_entity_extraction":
-                    # fields_extracted, usage = ("hola", 2000)
-                    fields_extracted, usage, content = chat_completions_entity_extraction(
-                        items[0], data_inject_folder, doctype
-                    )
-                else:
-                    errorMsg = "Método de procesamiento no valido."
-                
-                if errorMsg == None:
-                    # Concatenamos a pages toda la informacion de la pagina actual
-                    extraction["pages"][itemCount] = {"process_type": process_type,"values": fields_extracted,"usage": usage,"content": str(content)}
-                    #Validamos algunos campos antes de regresar la información
-                    isFatalError, validated_values = Utils.validate_fields(extraction["pages"][itemCount])
-                    
-                    if isFatalError:
-                        extraction["pages"][itemCount]["values"] = {"detail" : validated_values}
-                    else:
-                        extraction["pages"][itemCount]["values"] = validated_values
-                else:
-                    extraction["pages"][itemCount] = {"detail": errorMsg}
-            else:
-                extraction["pages"][itemCount] = {"detail": errorMsg}
-            itemCount += 1
+    
+        #Validamos algunos campos antes de regresar la información
+        isFatalError, validated_values = Utils.validate_fields(extraction)
+        if isFatalError:
+            raise ValueError(validated_values)
+    
+        extraction["values"] = validated_values
         return extraction
-            
+
+async def page_extraction(items, doctype) -> dict:
+    """
+    Extracts the fields of a single page of a multi-page document.
+        Args:
+            items: List with the text extracted, confidence, handwriting flag and improved page image.
+            doctype: Type of document to process. It can be one of the following: IMSS, INFONAVIT, SAT.
+        Returns:
+            dict: The page extraction, or the error detail of the page.
+    """
     # Validar la calidad del texto extraído
-    text_quality, message, process_type = raw_text_validator(text_extracted, doctype, docConfidence, hasManuscript)
+    text_quality, message, process_type = raw_text_validator(items[0], doctype, items[1], items[2])
     print (text_quality,message,process_type)
-    
-    # Si el texto es inválido, lanzar error
+
+    # Si el texto es inválido, anexar error
     if not text_quality:
-        raise ValueError(message)
-    
+        return {"detail": message}
+
     # Procesar con la función correspondiente
+    if process_type not in ("vision_entity_extraction", "chat_completions_entity_extraction"):
+        return {"detail": "Método de procesamiento no valido."}
+    process_type, fields_extracted, usage, content = await entity_extraction(
+        items[0], items[1], process_type, items[3], doctype
+    )
+
+    # Contruimos la informacion de la pagina actual
+    page = {"process_type": process_type,"values": fields_extracted,"usage": usage,"content": str(content),"encoding": items[3].encodings()}
+    #Validamos algunos campos antes de regresar la información
+    isFatalError, validated_values = Utils.validate_fields(page)
+
+    if isFatalError:
+        page["values"] = {"detail" : validated_values}
+    else:
+        page["values"] = validated_values
+    return page
+
+async def entity_extraction(text_extracted, docConfidence, process_type, page_image, doctype) -> tuple:
+    """
+    Extracts the fields of a page. The fields found verbatim in the text are resolved
+    by rules; if they cover the whole document the LLM is skipped, otherwise the LLM
+    extracts the page and the rule values replace its values.
+        Args:
+            text_extracted: Text of the page.
+            docConfidence: OCR confidence of the text.
+            process_type: vision_entity_extraction or chat_completions_entity_extraction.
+            page_image: Improved page (PageImage or LazyPageImage).
+            doctype: Type of document to process. It can be one of the following: IMSS, INFONAVIT, SAT.
+        Returns:
+            tuple: process type used, fields extracted, usage and content sent to the model.
+    """
+    rule_fields = extract_fields(text_extracted, doctype, docConfidence)
+    if is_complete(rule_fields, doctype):
+        print(f"All the {doctype} fields were resolved by rules, LLM skipped")
+        return "rule_extraction", rule_fields, None, ""
+
     if process_type == "vision_entity_extraction":
-        # fields_extracted, usage = ("hola", 2000)
-        fields_extracted, usage, content = vision_entity_extraction(
-            improved_image_path, image_inject_folder, doctype
-        )
-    elif process_type == "chat_completions_entity_extraction":
-        # fields_extracted, usage = (text_extracted, 2000)
-        fields_extracted, usage, content = chat_completions_entity_extraction(
+        # Las paginas que usaron la capa de texto del PDF se rasterizan hasta este punto
+        page_image = await page_image.load()
+        region_extraction = None
+        if uses_regions(doctype):
+            # Solo se envian las regiones inciertas si el OCR dejo su geometria
+            region_extraction = await vision_region_extraction(page_image, doctype)
+        if region_extraction is not None and region_extraction[0] is not None:
+            process_type = "vision_roi_entity_extraction"
+            fields_extracted, usage, content = region_extraction
+        else:
+            fields_extracted, usage, content = await vision_entity_extraction(
+                page_image, image_inject_folder, doctype
+            )
+            # Los tokens de la llamada por regiones que fallo tambien se reportan
+            if region_extraction is not None:
+                usage = add_usage(usage, region_extraction[1])
+    else:
+        fields_extracted, usage, content = await chat_completions_entity_extraction(
             text_extracted, data_inject_folder, doctype
         )
-    else:
-        raise ValueError("Método de procesamiento no valido.")
-
-    # Contruimos JSON dictionary
-    extraction = {
-        "filename": os.path.basename(file_path),
-        "doc_type": doctype,
-        "process_type": process_type,
-        "values": fields_extracted,
-        "usage": usage,
-        "content": str(content),
-    }
-    
-    #Validamos algunos campos antes de regresar la información
-    isFatalError, validated_values = Utils.validate_fields(extraction)
-    if isFatalError:
-        raise ValueError(validated_values)
-    
-    extraction["values"] = validated_values
-    return extraction
+    return process_type, merge_fields(fields_extracted, rule_fields), usage, content
 
 def raw_text_validator(text_extracted, doctype, docConfidence, hasManuscript = False):
     """
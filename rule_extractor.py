@@ -0,0 +1,131 @@
+# %% Rule based extraction
+
+from utils.general_utils import Utils
+from example_store import OUTPUT_FORMATS
+from dotenv import load_dotenv
+import json
+import re
+import os
+
+"""
+Deterministic extraction of the fields that appear verbatim in the text of a
+document (CURP, RFC, NSS, postal code, folio...).
+
+Each field is taken only when its rule finds a single candidate and the value
+passes Utils.validate_fields. When every field of the doc type is resolved
+(e.g. a clean SAT constancia) the LLM is not called; otherwise the LLM extracts
+the document and the resolved fields replace its values.
+
+- RULES_MIN_CONFIDENCE: minimum OCR confidence of the text to apply the rules.
+"""
+
+load_dotenv()
+RULES_MIN_CONFIDENCE = float(os.environ.get("RULES_MIN_CONFIDENCE", 90))
+
+CURP_PATTERN = r"[A-Z]{4}\d{6}[HM][A-Z]{5}[A-Z0-9]\d"
+# RFC de persona fisica (13 caracteres) y de persona moral (12 caracteres)
+RFC_PERSONA_FISICA_PATTERN = r"[A-ZÑ&]{4}\d{6}[A-Z0-9]{2}[0-9A]"
+RFC_PERSONA_MORAL_PATTERN = r"[A-ZÑ&]{3}\d{6}[A-Z0-9]{2}[0-9A]"
+NAME_PATTERN = r"[A-ZÁÉÍÓÚÜÑ][A-ZÁÉÍÓÚÜÑ .']{0,59}"
+
+# Reglas por tipo de documento: campo -> expresion con un grupo para el valor.
+# Las etiquetas se buscan sin importar mayusculas ni espacios, ya que el OCR de
+# Textract une las lineas con espacios y la capa de texto del PDF las omite.
+RULES = {
+    "SAT": {
+        "codigo_postal": r"C[oó]digo\s*Postal\s*:\s*(\d{5})\b",
+        "curp": rf"CURP\s*:\s*({CURP_PATTERN})\b",
+        "nombres": rf"Nombre\s*\(s\)\s*:\s*({NAME_PATTERN}?)\s*Primer\s*Apellido",
+        "primer_apellido": rf"Primer\s*Apellido\s*:\s*({NAME_PATTERN}?)\s*Segundo\s*Apellido",
+        "segundo_apellido": rf"Segundo\s*Apellido\s*:\s*({NAME_PATTERN}?)\s*Fecha\s*inicio",
+        "rfc": rf"RFC\s*:\s*({RFC_PERSONA_FISICA_PATTERN}|{RFC_PERSONA_MORAL_PATTERN})\b",
+        "estatus_en_el_padron": r"Estatus\s*en\s*el\s*padr[oó]n\s*:\s*([A-ZÁÉÍÓÚ]+)\b",
+    },
+    "INFONAVIT": {
+        "folio": r"FOLIO\s*:?\s*([RS]?\d{12,13})\b",
+        "rfc": rf"\b({RFC_PERSONA_FISICA_PATTERN})\b",
+        "rfc_patron": rf"\b({RFC_PERSONA_MORAL_PATTERN})\b",
+        "numero_de_seguridad_social": r"N\.?\s*S\.?\s*S\.?\D{0,40}?\b(\d{11})\b",
+    },
+    "IMSS": {
+        "curp": rf"\b({CURP_PATTERN})\b",
+    },
+}
+
+# Etiquetas que no distinguen mayusculas, los valores si
+_LABEL_FLAGS = {"SAT": True, "INFONAVIT": True, "IMSS": False}
+
+
+def output_fields(doctype) -> list:
+    """
+    Returns the fields of the output JSON of a doc type, None if its format is not plain JSON.
+    """
+    try:
+        return list(json.loads(OUTPUT_FORMATS[doctype]).keys())
+    except (KeyError, ValueError):
+        return None
+
+
+def find_field(pattern, text, ignore_label_case=True) -> str:
+    """
+    Returns the single distinct value matched by the pattern, None if there is no
+    match or if the matches disagree.
+    """
+    flags = re.IGNORECASE if ignore_label_case else 0
+    candidates = set()
+    for match in re.finditer(pattern, text, flags):
+        value = re.sub(r"\s+", " ", match.group(1)).strip()
+        if value:
+            candidates.add(value)
+    if len(candidates) != 1:
+        return None
+    return candidates.pop()
+
+
+def is_valid(field, value) -> bool:
+    """
+    Checks a value with the same rules applied to the LLM output.
+    """
+    isFatalError, validated = Utils.validate_fields({"values": {field: value}})
+    return not isFatalError and "Error" not in str(validated[field])
+
+
+def extract_fields(text_extracted, doctype, docConfidence=100) -> dict:
+    """
+    Extracts the fields of a doc type that can be resolved with its rules.
+        Args:
+            text_extracted: OCR or PDF text of the page.
+            doctype: Type of document (IMSS, INFONAVIT, SAT).
+            docConfidence: OCR confidence of the text, rules are not applied below RULES_MIN_CONFIDENCE.
+        Returns:
+            dict: The resolved fields, only the ones with a single valid value.
+    """
+    if not isinstance(text_extracted, str) or docConfidence is None:
+        return {}
+    if docConfidence < RULES_MIN_CONFIDENCE:
+        return {}
+    fields = {}
+    for field, pattern in RULES.get(doctype, {}).items():
+        value = find_field(pattern, text_extracted, _LABEL_FLAGS.get(doctype, True))
+        if value is not None and value.upper() == value and is_valid(field, value):
+            fields[field] = value
+    return fields
+
+
+def is_complete(fields, doctype) -> bool:
+    """
+    Checks if the rules resolved every field of the doc type, so the LLM can be skipped.
+    """
+    expected = output_fields(doctype)
+    return bool(expected) and all(field in fields for field in expected)
+
+
+def merge_fields(fields_extracted, rule_fields) -> dict:
+    """
+    Replaces the LLM values with the values resolved by the rules.
+    """
+    if not isinstance(fields_extracted, dict):
+        return fields_extracted
+    merged = dict(fields_extracted)
+    merged.update(rule_fields)
+    return merged
@@ -0,0 +1,170 @@
+# %% Sub-type classifier
+
+from example_store import get_example_files, files_signature, EXAMPLES_DEPTH
+from utils.file_utils import FileUtils
+from unidecode import unidecode
+from dotenv import load_dotenv
+from collections import Counter
+import threading
+import math
+import re
+import os
+
+"""
+Local TF-IDF classifier that predicts the sub-type of a document (the subfolder
+of 'data_inject/<doctype>', e.g. ALTA or SUSPENSION) from its OCR text, so the
+chat prompt only carries the examples of that sub-type.
+
+The model is built from the 'data_*' examples of each subfolder: every sub-type
+is the normalized centroid of the TF-IDF vectors of its examples, and a text is
+assigned to the most similar centroid by cosine similarity. When the best score
+is below SUBTYPE_MIN_SCORE, or too close to the second one (SUBTYPE_MIN_MARGIN),
+no sub-type is returned and the prompt with every example is used.
+"""
+
+load_dotenv()
+SUBTYPE_MIN_SCORE = float(os.environ.get("SUBTYPE_MIN_SCORE", 0.2))
+SUBTYPE_MIN_MARGIN = float(os.environ.get("SUBTYPE_MIN_MARGIN", 0.2))
+
+_lock = threading.Lock()
+_classifiers = {}
+
+
+def tokenize(text) -> list:
+    """
+    Words and word pairs of a text, without accents, numbers or words shorter than 3 letters.
+    Numbers are left out because they identify the document, not its sub-type.
+    """
+    words = re.findall(r"[a-z]{3,}", unidecode(text).lower())
+    return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+
+class SubtypeClassifier:
+    """
+    Nearest-centroid TF-IDF classifier over the sub-types of a doc type.
+        Args:
+            examples: dict {sub_type: [raw texts]}.
+            signature: mtime/size snapshot of the files used to build the model.
+    """
+
+    def __init__(self, examples, signature=()):
+        self.signature = signature
+        documents = [
+            (sub_type, Counter(tokenize(text)))
+            for sub_type, texts in examples.items()
+            for text in texts
+        ]
+        document_frequency = Counter()
+        for _, counts in documents:
+            document_frequency.update(counts.keys())
+        total = len(documents)
+        self.idf = {
+            term: math.log((1 + total) / (1 + frequency)) + 1
+            for term, frequency in document_frequency.items()
+        }
+
+        centroids = {}
+        for sub_type, counts in documents:
+            centroid = centroids.setdefault(sub_type, Counter())
+            centroid.update(self.vectorize(counts))
+        self.centroids = {
+            sub_type: self.normalize(centroid) for sub_type, centroid in centroids.items()
+        }
+
+    def vectorize(self, counts) -> dict:
+        """
+        Normalized TF-IDF vector of the term counts, with sublinear term frequency.
+        Terms that are not in the examples are ignored.
+        """
+        vector = {
+            term: (1 + math.log(count)) * self.idf[term]
+            for term, count in counts.items()
+            if term in self.idf
+        }
+        return self.normalize(vector)
+
+    @staticmethod
+    def normalize(vector) -> dict:
+        norm = math.sqrt(sum(value * value for value in vector.values()))
+        if norm == 0:
+            return {}
+        return {term: value / norm for term, value in vector.items()}
+
+    def scores(self, text) -> dict:
+        """
+        Cosine similarity of the text with every sub-type.
+        """
+        vector = self.vectorize(Counter(tokenize(text)))
+        return {
+            sub_type: sum(value * centroid.get(term, 0) for term, value in vector.items())
+            for sub_type, centroid in self.centroids.items()
+        }
+
+    def predict(self, text, min_score=SUBTYPE_MIN_SCORE, min_margin=SUBTYPE_MIN_MARGIN) -> tuple:
+        """
+        Predicts the sub-type of a text.
+            Returns:
+                tuple: (sub_type, score), sub_type is None when the prediction is not reliable.
+        """
+        ranking = sorted(self.scores(text).items(), key=lambda item: item[1], reverse=True)
+        if not ranking:
+            return None, 0
+        sub_type, score = ranking[0]
+        margin = score - ranking[1][1] if len(ranking) > 1 else score
+        if score < min_score or margin < min_margin:
+            return None, score
+        return sub_type, score
+
+
+def get_subtype_classifier(data_inject_folder, doctype) -> SubtypeClassifier:
+    """
+    Returns the cached classifier of a doc type, building it if it is not cached yet or
+    if any example changed. Doc types without subfolders return None.
+    """
+    if EXAMPLES_DEPTH.get(doctype, 1) < 2:
+        return None
+    signature = files_signature(get_example_files(data_inject_folder, doctype))
+    key = (data_inject_folder, doctype)
+    cached = _classifiers.get(key)
+    if cached is not None and cached.signature == signature:
+        return cached
+
+    with _lock:
+        cached = _classifiers.get(key)
+        if cached is not None and cached.signature == signature:
+            return cached
+
+        sub_folder = os.path.join(data_inject_folder, doctype)
+        examples = {}
+        for file, _, _ in signature:
+            if not os.path.basename(file).startswith("data"):
+                continue
+            sub_type = os.path.relpath(os.path.dirname(file), sub_folder)
+            examples.setdefault(sub_type, []).append(FileUtils.read(file))
+
+        classifier = SubtypeClassifier(examples, signature)
+        _classifiers[key] = classifier
+        print(f"Built sub-type classifier for {doctype}: {sorted(examples)}")
+        return classifier
+
+
+def predict_subtype(data_inject_folder, doctype, text) -> str:
+    """
+    Predicts the sub-type of an OCR text.
+        Returns:
+            str: Name of the subfolder, None if the doc type has no sub-types or the prediction is not reliable.
+    """
+    classifier = get_subtype_classifier(data_inject_folder, doctype)
+    if classifier is None:
+        return None
+    sub_type, score = classifier.predict(text)
+    print(f"Predicted sub-type for {doctype}: {sub_type} (score {round(score, 3)})")
+    return sub_type
+
+
+def preload(data_inject_folder) -> None:
+    """
+    Builds the classifier of every doc type with sub-types, so the first requests don't pay for it.
+    """
+    for doctype in EXAMPLES_DEPTH:
+        get_subtype_classifier(data_inject_folder, doctype)
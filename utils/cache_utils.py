@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+# Carpeta base de las caches en disco
+CACHE_FOLDER = os.environ.get("CACHE_FOLDER", os.path.join(os.getcwd(), ".cache"))
+
+
+class DiskCache:
+    """
+    Content-addressed cache stored as one file per key, with size and TTL eviction.
+    Writes are atomic, so several processes can share the same folder.
+        parameters:
+            folder_path: str - folder where the entries are stored
+            max_bytes: int - size of the folder above which the least recently used entries are deleted
+            ttl_seconds: float|None (default=None) - age after which an entry expires, None to never expire
+    """
+
+    def __init__(self, folder_path, max_bytes, ttl_seconds=None):
+        self.folder_path = folder_path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        os.makedirs(folder_path, exist_ok=True)
+        self._size = sum(entry[3] for entry in self._entries())
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        """
+        Builds a SHA-256 key from str or bytes parts
+        """
+        digest = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode()
+            digest.update(hashlib.sha256(part).digest())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder_path, key[:2], key)
+
+    def _entries(self):
+        """
+        Returns (path, last use, creation, size) of every entry in the cache
+        """
+        entries = []
+        for root, dirs, files in os.walk(self.folder_path):
+            for file in files:
+                file_path = os.path.join(root, file)
+                try:
+                    stat = os.stat(file_path)
+                except FileNotFoundError:
+                    continue
+                entries.append((file_path, stat.st_atime, stat.st_mtime, stat.st_size))
+        return entries
+
+    def get(self, key):
+        """
+        Returns the bytes stored for key, or None if missing or expired
+        """
+        file_path = self._path(key)
+        try:
+            stat = os.stat(file_path)
+            if self.ttl_seconds is not None and time.time() - stat.st_mtime > self.ttl_seconds:
+                self._remove(file_path, stat.st_size)
+                return None
+            with open(file_path, "rb") as file:
+                data = file.read()
+            # Marcamos la entrada como usada recientemente (atime) para la eviccion LRU,
+            # el mtime conserva la fecha de creacion para el TTL
+            os.utime(file_path, (time.time(), stat.st_mtime))
+            return data
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, data):
+        """
+        Stores bytes for key and evicts the least recently used entries if needed
+        """
+        file_path = self._path(key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path))
+        with os.fdopen(file_descriptor, "wb") as file:
+            file.write(data)
+        with self._lock:
+            # Si la clave ya existia descontamos el archivo que se reemplaza
+            try:
+                previous_size = os.stat(file_path).st_size
+            except FileNotFoundError:
+                previous_size = 0
+            os.replace(temp_path, file_path)
+            self._size += len(data) - previous_size
+            over_limit = self._size > self.max_bytes
+        if over_limit:
+            self.evict()
+
+    def get_json(self, key):
+        data = self.get(key)
+        return json.loads(data) if data is not None else None
+
+    def set_json(self, key, value):
+        self.set(key, json.dumps(value, ensure_ascii=False).encode())
+
+    def evict(self):
+        """
+        Deletes expired entries and then the least recently used ones until the
+        cache is under 90% of its maximum size
+        """
+        with self._lock:
+            entries = sorted(self._entries(), key=lambda entry: entry[1])
+            size = sum(entry[3] for entry in entries)
+            now = time.time()
+            for file_path, atime, mtime, file_size in entries:
+                expired = self.ttl_seconds is not None and now - mtime > self.ttl_seconds
+                if not expired and size <= self.max_bytes * 0.9:
+                    continue
+                try:
+                    os.unlink(file_path)
+                    size -= file_size
+                except FileNotFoundError:
+                    pass
+            self._size = size
+
+    def _remove(self, file_path, file_size):
+        try:
+            os.unlink(file_path)
+            with self._lock:
+                self._size -= file_size
+        except FileNotFoundError:
+            pass
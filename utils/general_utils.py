@@ -91,6 +91,8 @@ class Utils:
             "gpt-4-32k-0613",
             "gpt-4-32k-0613",
             "gpt-4-vision-preview",
+            "gpt-4o",
+            "gpt-4o-mini",
         }:
             tokens_per_message = 3
             tokens_per_name = 1
@@ -261,6 +263,18 @@ class Utils:
                     if not patron_RFC.match(fields["rfc"]):
                         fields["rfc"] = f"Error: El RFC '{fields['rfc']}' es incorrecto."
 
+            # Validacion de RFC del patron
+            if "rfc_patron" in fields:
+                if fields["rfc_patron"] in ("","NA",None):
+                    fields["rfc_patron"] = "Error: No se encontró el RFC del patrón"
+                else:
+                    # Las razones sociales pueden incluir '&' en las primeras letras del RFC
+                    patron_RFC_patron = re.compile(r"^[A-ZÑ&]{3,4}[0-9]{6}[A-V0-9]{2}[0-9A]$")
+
+                    # Validar el formato de RFC
+                    if not patron_RFC_patron.match(fields["rfc_patron"]):
+                        fields["rfc_patron"] = f"Error: El RFC del patrón '{fields['rfc_patron']}' es incorrecto."
+
             # Validacion de Fechas
             for key in fields.keys():
                 if "fecha" in key:
@@ -1,91 +1,51 @@
 # %% Google Gemini 2.0 Flash Lite Vision Recognition
 
-from google import genai
 from google.genai import types
-from utils.file_utils import FileUtils
 from utils.general_utils import Utils
-from dotenv import load_dotenv
+from example_store import get_vision_examples, select_vision_examples, OUTPUT_FORMATS, VISION_MODEL
+from clients import get_gemini_client
+from executors import run_cpu_bound, run_blocking
 import sys
 import os
-import PIL.Image
-import json
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-load_dotenv()
-GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
-
-def vision_entity_extraction(image_path, image_inject_folder, type_doc) -> tuple:
+async def vision_entity_extraction(page_image, image_inject_folder, type_doc) -> tuple:
     """
-    -> image_path -> result
+    -> page_image -> result
     
     Receives the image to process and returns a JSON with the relevant fields.
     This function use Gemini 2.0 Flash Lite from Google.
     
         Args:
-            image_path: The image file path to process.
+            page_image: The improved page (PageImage) to process.
             image_inject_folder: The folder path of the context data for the system.
             type_doc: The folder path of the context data that is going to be pass to the system.
             
         Return:
             A structured JSON with the relevant fields extracted.
     """
-    # Define variables
-    input_results_list = []
-    input_image_list = []
-    image_count = 0
-    results_count = 0
-    all_image_inject_files = []
-    # Retrieve files from 'Data Inject'
-    if type_doc == "IMSS":
-        data_inject_sub_folder = os.path.join(image_inject_folder, "IMSS")
-        all_image_inject_files = FileUtils.get_paths(data_inject_sub_folder, 2)
-    elif type_doc == "INFONAVIT":
-        data_inject_sub_folder = os.path.join(image_inject_folder, "INFONAVIT")
-        all_image_inject_files = FileUtils.get_paths(data_inject_sub_folder, 2)
-    elif type_doc == "SAT":
-        data_inject_sub_folder = os.path.join(image_inject_folder, "SAT")
-        all_image_inject_files = FileUtils.get_paths(data_inject_sub_folder, 1)
-    else:
-        raise ValueError(
-            "Tipo de documento no reconozido. Por favor, proporcione un tipo de documento válido: IMSS, INFONAVIT, SAT"
-        )
+    # Retrieve cached examples from 'Image Inject' and keep the closest ones to the page
+    # La revision de los archivos (y la recarga si cambiaron) se hace fuera del event loop
+    examples = await run_blocking(get_vision_examples, image_inject_folder, type_doc)
+    # La huella de la pagina (reduccion y gris del raster completo) se calcula fuera del event loop
+    examples = await run_cpu_bound(select_vision_examples, examples, page_image.array)
+    image_count = len(examples.images)
 
-    for file in all_image_inject_files:
-        file_name = os.path.basename(file)
-        if file_name.startswith("result"):
-            input_results_list.append(FileUtils.read(file))
-            results_count += 1
-        elif file_name.startswith("image"):
-            image = PIL.Image.open(file)
-            input_image_list.append(image)
-            image_count += 1
-        else:
-            print(f"Documento: {file} no reconozido.")
-    
     # Set context data
     first_line_context = f"The next {image_count} images are examples of documents you will receive and next them the JSON's of the relevant information extracted in key pairs of each one, respectively."
     last_line_context = f"Your task is to parse the last image, recognize the entities to extract, and create a JSON with the relevant entities. Use the following format for the output JSON:\n\n"
-    if type_doc == "IMSS":
-        last_line_context += '{"serie_y_folio": "string", "tipo_incapacidad": "string", "ramo_de_seguro": "string", "probable_riesgo_trabajo": "string", "dias_autorizados": "string", "fecha_a_partir": "date (DD/MM/YYYY)", "fecha_expedido": "date (DD/MM/YYYY)", "numero_de_seguridad_social": "string", "curp": "string", "nombre_del_asegurado": "string", "clave_patronal": "string", "nombre_del_patron": "string"}'
-
-    elif type_doc == "INFONAVIT":
-        last_line_context += '{"titulo": "string", "motivo": "ALTA|SUSPENSION", "folio": "string", "fecha_notificacion": "date (DD/MM/YYYY)", "fecha_emision": "date (DD/MM/YYYY)", "fecha_tramite": "date (DD/MM/YYYY)", "fecha_recepcion": "date (DD/MM/YYYY)", "numero_de_credito": "string", "descuento": "oneOf": "[{"cantidad": "string"}, {"porcentaje": "string"}, {"factor": "string"}]", "rfc": "string", "numero_de_seguridad_social": "string", "rfc_patron": "string", "numero_de_registro_patronal": "string", "razon_social": "string", "sello_de_la_empresa": "true|false", "leyenda_aplicacion_descuento": "string"}'
-
-    elif type_doc == "SAT":
-        last_line_context += '{"codigo_postal": "number", "curp": "string", "nombres": "string", "primer_apellido": "string", "segundo_apellido": "string", "rfc": "string", "estatus_en_el_padron": "string"}'
-    else:
-        raise ValueError(
-            "Tipo de documento no reconozido. Por favor, proporcione un tipo de documento válido: IMSS, INFONAVIT, SAT"
-        )
+    last_line_context += OUTPUT_FORMATS[type_doc]
 
     # Set content data
     content = []
     content.append(first_line_context)
-    content.append(input_image_list)
-    content.append(input_results_list)
+    content.append(list(examples.images))
+    content.append(list(examples.results))
     content.append(last_line_context)
-    content.append(PIL.Image.open(image_path))
+    # La pagina se codifica dentro del presupuesto de vision, fuera del event loop
+    encoded = await run_cpu_bound(page_image.encode_for, "vision")
+    content.append(types.Part.from_bytes(data=encoded.data, mime_type=encoded.mime_type))
     
     
     # return content,200,1
@@ -94,7 +54,7 @@ def vision_entity_extraction(image_path, image_inject_folder, type_doc) -> tuple
 # type_doc="SAT"
 # vision_entity_extraction(image_path, image_inject_folder, type_doc)
 
-    client = genai.Client(api_key=GEMINI_API_KEY)
+    client = get_gemini_client()
 #     response = client.models.count_tokens(
 #         model="gemini-2.0-flash-lite",
 #         contents=content,
@@ -107,8 +67,8 @@ def vision_entity_extraction(image_path, image_inject_folder, type_doc) -> tuple
 # image_inject_folder = os.path.join(os.getcwd(), "image_inject")
 # type_doc="SAT"
 # vision_entity_extraction(image_path, image_inject_folder, type_doc)
-    response = client.models.generate_content(
-        model="gemini-2.0-flash-lite",
+    response = await client.aio.models.generate_content(
+        model=VISION_MODEL,
         contents=content,
     )
     
@@ -121,7 +81,9 @@ def vision_entity_extraction(image_path, image_inject_folder, type_doc) -> tuple
     json_data = Utils.to_dict(json_string)
     print("------------------")
     print(json_data)
-    return json_data,response.usage_metadata,content
+    # Las imagenes de ejemplo se reportan por nombre para no devolver sus bytes
+    content_summary = [first_line_context, list(examples.image_names), list(examples.results), last_line_context, page_image.name]
+    return json_data,response.usage_metadata,content_summary
 
 
 # # %%improved pdf to images
@@ -0,0 +1,222 @@
+# %% Region of interest vision extraction
+
+from google.genai import types
+from utils.general_utils import Utils
+from example_store import OUTPUT_FORMATS, VISION_MODEL
+from clients import get_gemini_client
+from executors import run_cpu_bound
+from page_image import PageImage
+from dotenv import load_dotenv
+import numpy as np
+import os
+
+"""
+Vision extraction that only sends the uncertain regions of a page to Gemini.
+
+A page goes to vision when its OCR confidence is low or it has handwriting,
+even if only one box (e.g. dias_autorizados on MT_A_MANO incapacidades) is the
+problem. With VISION_ROI_ENABLED, the OCR words below ROI_MIN_CONFIDENCE or
+handwritten are grouped into a few regions, and Gemini receives the OCR text of
+the page, with each uncertain word replaced by the marker of its region, and the
+crops of those regions instead of the whole page.
+
+The full page is sent as before when the page has no OCR geometry (text layer
+pages), no uncertain words, or when the regions are too many or too large
+(ROI_MAX_REGIONS, ROI_MAX_AREA) to save anything.
+
+- VISION_ROI_DOCTYPES: doc types that use the regions. INFONAVIT is left out by
+  default because the company seal is not a text region.
+- ROI_PADDING_X / ROI_PADDING_Y: margin of each region, as a fraction of the
+  page width and as a multiple of the word height, so the labels are included.
+"""
+
+load_dotenv()
+VISION_ROI_ENABLED = os.environ.get("VISION_ROI_ENABLED", "false").lower() in ("1", "true", "yes")
+VISION_ROI_DOCTYPES = [
+    doctype.strip().upper()
+    for doctype in os.environ.get("VISION_ROI_DOCTYPES", "IMSS,SAT").split(",")
+    if doctype.strip()
+]
+ROI_MIN_CONFIDENCE = float(os.environ.get("ROI_MIN_CONFIDENCE", 90))
+ROI_PADDING_X = float(os.environ.get("ROI_PADDING_X", 0.03))
+ROI_PADDING_Y = float(os.environ.get("ROI_PADDING_Y", 1.5))
+ROI_MAX_REGIONS = int(os.environ.get("ROI_MAX_REGIONS", 6))
+ROI_MAX_AREA = float(os.environ.get("ROI_MAX_AREA", 0.5))
+
+
+def uses_regions(doctype) -> bool:
+    return VISION_ROI_ENABLED and doctype in VISION_ROI_DOCTYPES
+
+
+def merge_regions(regions) -> list:
+    """
+    Joins the overlapping regions (x0, y0, x1, y1) until none overlap.
+    """
+    regions = [list(region) for region in regions]
+    merged = True
+    while merged:
+        merged = False
+        result = []
+        for region in regions:
+            for other in result:
+                if (
+                    region[0] <= other[2] and other[0] <= region[2]
+                    and region[1] <= other[3] and other[1] <= region[3]
+                ):
+                    other[:] = [
+                        min(region[0], other[0]), min(region[1], other[1]),
+                        max(region[2], other[2]), max(region[3], other[3]),
+                    ]
+                    merged = True
+                    break
+            else:
+                result.append(region)
+        regions = result
+    return sorted(regions, key=lambda region: (region[1], region[0]))
+
+
+def select_regions(ocr_blocks, min_confidence=ROI_MIN_CONFIDENCE) -> tuple:
+    """
+    Groups the uncertain words of a page into regions.
+        Args:
+            ocr_blocks (OcrBlocks): OCR blocks of the page.
+            min_confidence (float): Words below this confidence, or handwritten, are uncertain.
+        Returns:
+            tuple: (regions, words, uncertain) with the regions as normalized (x0, y0, x1, y1)
+                   boxes, or None if the page should be sent whole.
+    """
+    if ocr_blocks is None:
+        return None
+    words = ocr_blocks.words()
+    uncertain = (words.confidences < min_confidence) | words.handwriting
+    if not uncertain.any():
+        return None
+
+    left, top, width, height = words.boxes[uncertain].T
+    padding_y = height * ROI_PADDING_Y
+    boxes = np.clip(
+        np.stack([
+            left - ROI_PADDING_X,
+            top - padding_y,
+            left + width + ROI_PADDING_X,
+            top + height + padding_y,
+        ], axis=1),
+        0,
+        1,
+    )
+    regions = merge_regions(boxes.tolist())
+    area = sum((region[2] - region[0]) * (region[3] - region[1]) for region in regions)
+    if len(regions) > ROI_MAX_REGIONS or area > ROI_MAX_AREA:
+        print(f"{len(regions)} regions covering {round(area * 100)}% of the page, sending the whole page")
+        return None
+    return regions, words, uncertain
+
+
+def region_text(words, uncertain, regions) -> str:
+    """
+    OCR text of the page in reading order, with each uncertain word replaced by the
+    marker of the region that contains it.
+    """
+    centers = words.boxes[:, :2] + words.boxes[:, 2:] / 2
+    parts = []
+    for index, text in enumerate(words.texts):
+        if not uncertain[index]:
+            parts.append(text)
+            continue
+        x, y = centers[index]
+        region_number = next(
+            (number for number, region in enumerate(regions, 1)
+             if region[0] <= x <= region[2] and region[1] <= y <= region[3]),
+            None,
+        )
+        marker = f"[R{region_number}]" if region_number else "[?]"
+        if not parts or parts[-1] != marker:
+            parts.append(marker)
+    return " ".join(parts)
+
+
+def crop_regions(page_image, regions) -> list:
+    """
+    Crops the regions from the page and encodes them within the vision budget.
+    """
+    height, width = page_image.array.shape[:2]
+    crops = []
+    for number, (x0, y0, x1, y1) in enumerate(regions, 1):
+        crop = page_image.array[
+            int(y0 * height):max(int(np.ceil(y1 * height)), int(y0 * height) + 1),
+            int(x0 * width):max(int(np.ceil(x1 * width)), int(x0 * width) + 1),
+        ]
+        crop_image = PageImage(f"{page_image.name} R{number}", crop, page_image.image_format)
+        crops.append(crop_image)
+    return [(crop, crop.encode_for("vision")) for crop in crops]
+
+
+async def vision_region_extraction(page_image, type_doc) -> tuple:
+    """
+    Extracts the fields of a page sending Gemini its OCR text and the crops of its uncertain regions.
+        Args:
+            page_image: The improved page (PageImage) with its OCR blocks.
+            type_doc: Type of document (IMSS, INFONAVIT, SAT).
+        Returns:
+            tuple: (json_data, usage, content_summary), or None if the regions were not sent. When
+                   the response could not be parsed, json_data is None and usage is the usage of
+                   the failed call, so it is added to the usage of the whole page.
+    """
+    selection = select_regions(page_image.ocr_blocks)
+    if selection is None:
+        return None
+    regions, words, uncertain = selection
+    text = region_text(words, uncertain, regions)
+    crops = await run_cpu_bound(crop_regions, page_image, regions)
+    print(f"Sending {len(crops)} regions of {page_image.name} to vision")
+
+    # Set context data
+    first_line_context = (
+        "The next text is the OCR of a document. The words the OCR could not read reliably "
+        f"were replaced by a region marker ([R1] to [R{len(crops)}]); the images after the text "
+        "are those regions of the document, in order. Read the regions to complete the text."
+    )
+    last_line_context = "Your task is to recognize the entities to extract from the text and the regions, and create a JSON with the relevant entities. Use the following format for the output JSON:\n\n"
+    last_line_context += OUTPUT_FORMATS[type_doc]
+
+    # Set content data
+    content = [first_line_context, text]
+    for number, (crop, encoded) in enumerate(crops, 1):
+        content.append(f"[R{number}]")
+        content.append(types.Part.from_bytes(data=encoded.data, mime_type=encoded.mime_type))
+    content.append(last_line_context)
+
+    client = get_gemini_client()
+    response = await client.aio.models.generate_content(
+        model=VISION_MODEL,
+        contents=content,
+    )
+
+    # Extract json content from response
+    json_string = response.text
+    json_string = json_string.replace("```json\n", "").replace("\n```", "")
+    print(json_string)
+    try:
+        json_data = Utils.to_dict(json_string)
+    except Exception as e:
+        json_data = None
+        print(f"Failed to parse the region extraction, sending the whole page. Reason: {e}")
+    content_summary = [first_line_context, text, [crop.name for crop, _ in crops], last_line_context]
+    if not isinstance(json_data, dict):
+        return None, response.usage_metadata, content_summary
+    return json_data, response.usage_metadata, content_summary
+
+
+def add_usage(usage, other):
+    """
+    Adds the token counts of two Gemini usage_metadata, e.g. a failed region call and
+    the whole page call that replaced it. Either of them can be None.
+    """
+    if usage is None or other is None:
+        return usage if other is None else other
+    counts = {}
+    for field, value in usage:
+        other_value = getattr(other, field, None)
+        if isinstance(value, int) or isinstance(other_value, int):
+            counts[field] = (value or 0) + (other_value or 0)
+    return usage.model_copy(update=counts)
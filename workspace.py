@@ -0,0 +1,87 @@
+from dotenv import load_dotenv
+from utils.file_utils import FileUtils
+import tempfile
+import uuid
+import os
+
+"""
+Per-request workspace. The pipeline keeps every stage in memory; the workspace
+only writes the stage outputs (raw, preprocessed, improved, text extracted)
+to its own folder when PIPELINE_DEBUG is enabled, so concurrent requests never
+read or delete each other's files. Resources that must live until the end of
+the request (e.g. the temporary file of a PDF) are closed with the workspace.
+"""
+
+load_dotenv()
+# Carpeta base donde se crean los workspaces de cada solicitud
+WORKSPACE_FOLDER = os.environ.get(
+    "WORKSPACE_FOLDER", os.path.join(tempfile.gettempdir(), "docExtractionIA")
+)
+# Guarda en disco las salidas de cada etapa y conserva el workspace al terminar
+PIPELINE_DEBUG = os.environ.get("PIPELINE_DEBUG", "false").lower() in ("1", "true", "yes")
+
+IMAGE_RAW = "0_image_raw"
+IMAGE_PREPROCESSED = "1_image_preprocessed"
+IMAGE_IMPROVED = "2_image_improved"
+TEXT_EXTRACTED = "3_text_extracted"
+
+
+class Workspace:
+    """
+    Debug output of a single request. Without debug mode nothing touches the disk.
+        Args:
+            request_id: Identifier of the request. A random one is generated if not given.
+            base_folder: Folder where the workspace is created.
+            debug: Persist the stage outputs and keep them after the request.
+    """
+
+    def __init__(self, request_id=None, base_folder=WORKSPACE_FOLDER, debug=PIPELINE_DEBUG):
+        self.request_id = request_id or uuid.uuid4().hex
+        self.debug = debug
+        self.root = None
+        self._resources = []
+        if self.debug:
+            os.makedirs(base_folder, exist_ok=True)
+            self.root = tempfile.mkdtemp(prefix=f"{self.request_id}_", dir=base_folder)
+            for stage in (IMAGE_RAW, IMAGE_PREPROCESSED, IMAGE_IMPROVED, TEXT_EXTRACTED):
+                os.makedirs(os.path.join(self.root, stage))
+
+    def save(self, stage, file_name, data):
+        """
+        Writes the output of a stage (str or bytes) when debug mode is enabled.
+            Returns:
+                str|None: The path of the written file, None if nothing was written.
+        """
+        if not self.debug:
+            return None
+        file_path = os.path.join(self.root, stage, os.path.basename(file_name))
+        return FileUtils.save(file_path, data)
+
+    def close_on_cleanup(self, resource):
+        """
+        Registers a resource with a close() method to be closed when the request ends.
+            Returns:
+                The same resource.
+        """
+        self._resources.append(resource)
+        return resource
+
+    def cleanup(self):
+        """
+        Releases the workspace and closes its resources. Debug files are kept on disk for inspection.
+        """
+        while self._resources:
+            resource = self._resources.pop()
+            try:
+                resource.close()
+            except Exception as e:
+                print(f"Failed to close {resource} of workspace {self.request_id}. Reason: {e}")
+        if self.root is not None:
+            print(f"Workspace {self.request_id} kept for debugging at {self.root}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+        return False